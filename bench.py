@@ -0,0 +1,473 @@
+"""End-to-end benchmark for JeanBot, without Discord or Azure.
+
+Starts local stand-ins for the TTS endpoint, Azure GPT and Reddit's
+top.json, a fake voice client and fake interactions, then runs the real
+command handlers for N guilds in parallel and prints throughput and
+p50/p95/p99 latency per command.
+
+    python bench.py --guilds 10 --users 3 --requests 20
+    python bench.py --commands joke,gpt --tts-latency 0.5 --error-rate 0.05
+    python bench.py --set tts_chunked_replies=false --json resultats.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict
+
+from aiohttp import web
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+COMMANDS = ("joke", "jokeqc", "say_vc", "gpt", "roast")
+SAY_TEXTS = [
+    "Salut la gang, c'est l'heure du dîner!",
+    "Ben voyons donc, t'es pas sérieux là.",
+    "Attache ta tuque avec de la broche, ça va brasser.",
+    "Il fait frette en maudit à matin, sortez les mitaines.",
+]
+GPT_QUERIES = [
+    "C'est quoi la capitale du Québec?",
+    "Explique la poutine en deux phrases.",
+    "Pourquoi le sirop d'érable est si bon?",
+]
+GPT_REPLY = (
+    "Bonne question! La réponse courte, c'est que ça dépend. "
+    "Mais si on regarde ça de proche, c'est pas mal plus simple qu'on pense. "
+    "Bref, garde ça en tête pour la prochaine fois."
+)
+ERROR_MARKERS = ("Erreur", "Accès refusé", "Trop d'attente", "File d'attente audio pleine",
+                 "trop de lectures", "Aucune blague")
+
+# ----- Faux serveurs HTTP -----
+class FakeBackends:
+    """aiohttp app imitating tts_url, azure_gpt_url and Reddit, with latency and errors."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.hits = defaultdict(int)
+        self.runner = None
+        self.base_url = None
+
+    async def _delay(self, mean):
+        if mean > 0:
+            await asyncio.sleep(mean * self.rng.uniform(0.5, 1.5))
+
+    def _fail(self):
+        return self.rng.random() < self.args.error_rate
+
+    def _throttled(self):
+        if self.rng.random() < self.args.throttle_rate:
+            self.hits["throttled"] += 1
+            return web.Response(status=429, headers={"Retry-After": "1"}, text="fake throttling")
+        return None
+
+    async def tts(self, request):
+        self.hits["tts"] += 1
+        body = await request.json()
+        throttled = self._throttled()
+        if throttled:
+            return throttled
+        await self._delay(self.args.tts_latency)
+        if self._fail():
+            self.hits["tts_errors"] += 1
+            return web.Response(status=500, text="fake TTS failure")
+        resp = web.StreamResponse(headers={"Content-Type": "audio/mpeg"})
+        await resp.prepare(request)
+        # ~100 octets de "mp3" par caractère, envoyés par morceaux comme le vrai service
+        size = max(4096, len(body.get("input", "")) * 100)
+        for offset in range(0, size, 4096):
+            await resp.write(b"\0" * min(4096, size - offset))
+            await asyncio.sleep(0)
+        await resp.write_eof()
+        return resp
+
+    async def gpt(self, request):
+        self.hits["gpt"] += 1
+        body = await request.json()
+        throttled = self._throttled()
+        if throttled:
+            return throttled
+        await self._delay(self.args.gpt_latency)
+        if self._fail():
+            self.hits["gpt_errors"] += 1
+            return web.Response(status=500, text="fake GPT failure")
+        if not body.get("stream"):
+            return web.json_response({"choices": [{"message": {"content": GPT_REPLY}}]})
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for token in GPT_REPLY.split(" "):
+            chunk = json.dumps({"choices": [{"delta": {"content": token + " "}}]})
+            await resp.write(f"data: {chunk}\n\n".encode("utf-8"))
+            if self.args.token_delay:
+                await asyncio.sleep(self.args.token_delay)
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def reddit(self, request):
+        sub = request.match_info["sub"]
+        self.hits["reddit"] += 1
+        await self._delay(self.args.reddit_latency)
+        if self._fail():
+            self.hits["reddit_errors"] += 1
+            return web.Response(status=503)
+        page = int((request.query.get("after") or "p0")[1:])
+        now = time.time()
+        children = [{"data": {
+            "name": f"t3_{sub}_{page}_{i}",
+            "title": f"Blague {page * 100 + i} de r/{sub}",
+            "selftext": f"Et la chute numéro {i}, évidemment.",
+            "score": 10000 - page * 100 - i,
+            "created_utc": now - (page * 100 + i) * 3600,
+            "subreddit": sub
+        }} for i in range(100)]
+        after = f"p{page + 1}" if page + 1 < self.args.reddit_pages else None
+        return web.json_response({"data": {"children": children, "after": after}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/tts", self.tts)
+        app.router.add_post("/gpt", self.gpt)
+        app.router.add_get("/r/{sub}/top.json", self.reddit)
+        app.router.add_get("/r/{sub}/new.json", self.reddit)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        host, port = self.runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+# ----- Fin faux serveurs -----
+
+# ----- Faux Discord -----
+class FakeOpusSource:
+    """Stands in for FFmpegOpusAudio/OpusFileAudio: drains the input like ffmpeg, then yields silent frames."""
+
+    def __init__(self, source, seconds):
+        self._source = source
+        self._frames = int(seconds / 0.02)
+
+    def read(self):
+        if self._source is not None:
+            if hasattr(self._source, "read"):  # TTSStream / SpeechSequence
+                while self._source.read(65536):
+                    pass
+            self._source = None
+        if self._frames <= 0:
+            return b""
+        self._frames -= 1
+        return b"\xf8\xff\xfe"
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        pass
+
+class FakeVoiceClient:
+    """Plays like discord.py's player: a thread reads 20 ms frames until b"", then calls after()."""
+
+    def __init__(self, bot, guild, channel, args):
+        self._bot = bot
+        self.guild = guild
+        self.channel = channel
+        self._args = args
+        self._connected = True
+        self._playing = False
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._playing
+
+    def play(self, source, after=None):
+        self._playing = True
+        threading.Thread(target=self._play, args=(source, after), daemon=True).start()
+
+    def _play(self, source, after):
+        error = None
+        start, frames = time.perf_counter(), 0
+        try:
+            while self._playing:
+                if not source.read():
+                    break
+                frames += 1
+                delay = start + frames * 0.02 - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+        except Exception as ex:
+            error = ex
+        self._playing = False
+        source.cleanup()
+        if after:
+            after(error)
+
+    def stop(self):
+        self._playing = False
+
+    async def move_to(self, channel):
+        await asyncio.sleep(self._args.connect_latency / 2)
+        self.channel = channel
+
+    async def disconnect(self, force=False):
+        self._connected = False
+        self._playing = False
+        self._bot._connection._voice_clients.pop(self.guild.id, None)
+
+class FakeChannel:
+    def __init__(self, bot, guild, channel_id, args):
+        self._bot = bot
+        self._args = args
+        self.guild = guild
+        self.id = channel_id
+        self.members = []
+
+    def permissions_for(self, member):
+        return types.SimpleNamespace(connect=True, speak=True)
+
+    async def connect(self):
+        await asyncio.sleep(self._args.connect_latency)
+        vc = FakeVoiceClient(self._bot, self.guild, self, self._args)
+        self._bot._connection._voice_clients[self.guild.id] = vc
+        return vc
+
+class FakeMember:
+    def __init__(self, user_id, channel):
+        self.id = user_id
+        self.name = f"membre{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+        self.voice = types.SimpleNamespace(channel=channel)
+
+    def __str__(self):
+        return self.name
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+class FakeInteraction:
+    def __init__(self, guild, user):
+        self.guild = guild
+        self.user = user
+        self.messages = []
+        self._done = False
+        self.response = types.SimpleNamespace(
+            defer=self._defer, send_message=self._send, is_done=lambda: self._done)
+        self.followup = types.SimpleNamespace(send=self._send)
+
+    async def _defer(self, **kwargs):
+        self._done = True
+
+    async def _send(self, content=None, **kwargs):
+        self._done = True
+        self.messages.append(content)
+        return FakeMessage()
+
+    async def edit_original_response(self, **kwargs):
+        pass
+
+    def failed(self):
+        return any(m and any(marker in m for marker in ERROR_MARKERS) for m in self.messages)
+# ----- Fin faux Discord -----
+
+def _parse_overrides(pairs):
+    overrides = {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+def _prepare_workdir(base_url, overrides):
+    """Temp dir with a config.json pointing at the fakes and links to ./Audio."""
+    workdir = tempfile.mkdtemp(prefix="jeanbot-bench-")
+    audio_dir = os.path.join(workdir, "Audio")
+    os.mkdir(audio_dir)
+    for name in os.listdir(os.path.join(REPO_DIR, "Audio")):
+        if name.endswith(".mp3"):
+            os.symlink(os.path.join(REPO_DIR, "Audio", name), os.path.join(audio_dir, name))
+    config = {
+        "token": "bench",
+        "api_key": "bench",
+        "tts_url": f"{base_url}/tts",
+        "azure_gpt_url": f"{base_url}/gpt",
+        "reddit_base_url": base_url,
+        "metrics_port": 0
+    }
+    config.update(overrides)
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(config, f)
+    return workdir
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+async def _run_command(bot, name, interaction, rng, member, n, unique):
+    suffix = f" (#{n})" if unique else ""
+    command = getattr(bot, name)
+    if name == "say_vc":
+        await command.callback(interaction, message=rng.choice(SAY_TEXTS) + suffix)
+    elif name == "gpt":
+        await command.callback(interaction, query=rng.choice(GPT_QUERIES) + suffix)
+    elif name == "roast":
+        await command.callback(interaction, cible=member, intensite=rng.randint(1, 5))
+    else:
+        await command.callback(interaction)
+
+async def _worker(bot, args, guild, channel, user_id, commands, results, counter):
+    rng = random.Random(f"{args.seed}-{guild.id}-{user_id}")
+    user = FakeMember(user_id, channel)
+    target = FakeMember(user_id + 1, channel)
+    for _ in range(args.requests):
+        name = rng.choice(commands)
+        counter[0] += 1
+        interaction = FakeInteraction(guild, user)
+        start = time.monotonic()
+        try:
+            await _run_command(bot, name, interaction, rng, target, counter[0], args.unique)
+            ok = not interaction.failed()
+        except Exception as ex:
+            logging.debug(f"{name} raised {ex!r}")
+            ok = False
+        results[name].append((time.monotonic() - start, ok))
+
+def _report(results, elapsed, bot, backends, corpus_seconds):
+    summary = {"elapsed_seconds": elapsed, "corpus_load_seconds": corpus_seconds, "commands": {}}
+    print(f"\nCorpus Reddit chargé en {corpus_seconds:.2f}s")
+    print(f"{'commande':<10} {'n':>5} {'err':>5} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'cmd/s':>7}")
+    total = 0
+    for name, samples in sorted(results.items()):
+        latencies = sorted(s for s, _ in samples)
+        errors = sum(1 for _, ok in samples if not ok)
+        total += len(samples)
+        row = {
+            "count": len(samples),
+            "errors": errors,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0,
+            "throughput": len(samples) / elapsed if elapsed else 0.0
+        }
+        summary["commands"][name] = row
+        print(f"{name:<10} {row['count']:>5} {errors:>5} {row['p50']:>7.3f}s {row['p95']:>7.3f}s "
+              f"{row['p99']:>7.3f}s {row['max']:>7.3f}s {row['throughput']:>7.2f}")
+    summary["throughput"] = total / elapsed if elapsed else 0.0
+    print(f"Total : {total} commandes en {elapsed:.2f}s ({summary['throughput']:.2f} cmd/s)")
+    # où part le temps : moyenne par étape, d'après les histogrammes du bot
+    stages = {}
+    print("\nÉtapes (moyenne, nombre) :")
+    for (name, labels), hist in sorted(bot._metric_histograms.items()):
+        label = name + "".join(f" {k}={v}" for k, v in labels)
+        mean = hist.total / hist.count if hist.count else 0.0
+        stages[label] = {"mean": mean, "count": hist.count}
+        print(f"  {label:<55} {mean:>7.3f}s {hist.count:>6}")
+    summary["stages"] = stages
+    summary["backend_hits"] = dict(backends.hits)
+    summary["tts_cache"] = bot.tts_cache.stats()
+    summary["gpt_stats"] = dict(bot.gpt_stats)
+    summary["voice_stats"] = dict(bot.voice_stats)
+    summary["backends"] = {l.name: dict(l.stats) for l in bot.backend_limiters}
+    summary["pools"] = {p.name: dict(p.stats) for p in bot.worker_pools}
+    summary["upstreams"] = {u.name: dict(u.stats, circuit=u.breaker.state) for u in bot.upstreams}
+    print(f"\nAppels aux faux serveurs : {dict(backends.hits)}")
+    print(f"Cache TTS : {summary['tts_cache']}")
+    print(f"GPT : {summary['gpt_stats']}")
+    print(f"Services : {summary['backends']}")
+    print(f"Azure : {summary['upstreams']}")
+    return summary
+
+async def main(args):
+    backends = FakeBackends(args)
+    await backends.start()
+    workdir = _prepare_workdir(backends.base_url, _parse_overrides(args.set))
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        import bot  # lit config.json dans le dossier courant
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.CRITICAL)
+        # pas de ffmpeg : chaque élément devient play_seconds de trames Opus muettes
+        bot._make_audio_source = lambda source: FakeOpusSource(source, args.play_seconds)
+
+        start = time.monotonic()
+        bot.set_reddit_jokes(await bot.load_reddit_jokes())
+        corpus_seconds = time.monotonic() - start
+        if args.warm_pool:
+            await bot._refill_joke_pool()
+
+        commands = [c.strip() for c in args.commands.split(",") if c.strip()]
+        unknown = set(commands) - set(COMMANDS)
+        if unknown:
+            raise SystemExit(f"Commandes inconnues : {', '.join(sorted(unknown))}")
+        results = defaultdict(list)
+        counter = [0]
+        workers = []
+        for g in range(args.guilds):
+            guild = types.SimpleNamespace(id=1000 + g, name=f"serveur{g}")
+            channel = FakeChannel(bot.bot, guild, 5000 + g, args)
+            for u in range(args.users):
+                workers.append(_worker(bot, args, guild, channel, 10 * (1000 + g) + u, commands, results, counter))
+        start = time.monotonic()
+        await asyncio.gather(*workers)
+        elapsed = time.monotonic() - start
+        summary = _report(results, elapsed, bot, backends, corpus_seconds)
+        if args.json:
+            with open(os.path.join(previous_cwd, args.json), "w") as f:
+                json.dump(summary, f, indent=2)
+
+        for task in list(bot._voice_queue_tasks.values()):
+            task.cancel()
+        await bot.close_http_session()
+    finally:
+        os.chdir(previous_cwd)
+        await backends.stop()
+        if args.keep:
+            print(f"Dossier de travail conservé : {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark bout-en-bout de JeanBot avec de faux services.")
+    parser.add_argument("--guilds", type=int, default=5, help="serveurs simulés en parallèle")
+    parser.add_argument("--users", type=int, default=2, help="membres actifs par serveur")
+    parser.add_argument("--requests", type=int, default=10, help="commandes lancées par membre")
+    parser.add_argument("--commands", default=",".join(COMMANDS), help="liste séparée par des virgules")
+    parser.add_argument("--tts-latency", type=float, default=0.3, help="secondes avant la réponse TTS")
+    parser.add_argument("--gpt-latency", type=float, default=0.4, help="secondes avant le premier jeton GPT")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="secondes entre deux jetons GPT")
+    parser.add_argument("--reddit-latency", type=float, default=0.1)
+    parser.add_argument("--reddit-pages", type=int, default=3, help="pages de 100 posts par subreddit")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="part des requêtes en erreur (0-1)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="part des requêtes TTS/GPT en 429 (0-1)")
+    parser.add_argument("--connect-latency", type=float, default=0.2, help="connexion au salon vocal")
+    parser.add_argument("--play-seconds", type=float, default=0.5, help="durée de lecture simulée")
+    parser.add_argument("--unique", action="store_true", help="textes tous différents (pas de cache)")
+    parser.add_argument("--warm-pool", action="store_true", help="pré-synthétiser la réserve de blagues")
+    parser.add_argument("--set", action="append", default=[], metavar="CLE=VALEUR",
+                        help="surcharge config.json du bot (valeur JSON), répétable")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="écrire le résumé dans ce fichier")
+    parser.add_argument("--keep", action="store_true", help="garder le dossier de travail temporaire")
+    parser.add_argument("--verbose", action="store_true", help="garder les logs du bot")
+    asyncio.run(main(parser.parse_args()))
@@ -1,27 +1,76 @@
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
+from discord.oggparse import OggStream
 import os
+import sys
 import random
 import json
 import asyncio
-import requests
-import tempfile
+import aiohttp
+from aiohttp import web
 import logging
+import logging.handlers
+import contextvars
 import math
-from collections import defaultdict
+import bisect
+import heapq
+import itertools
+import re
+from collections import defaultdict, OrderedDict, deque
 import time  # Pour le système de blocage
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Any, Dict
 import threading
+import queue
+import sqlite3
+import atexit
+import functools
+import hashlib
+import subprocess
+import concurrent.futures
+import signal
+try:
+    import fcntl
+except ImportError:  # Windows : pas de verrou entre processus, lancer un seul processus
+    fcntl = None
+
+PROCESS_START = time.monotonic()  # référence des durées de démarrage
 
 with open("config.json", "r") as f:
     config = json.load(f)
 
 AUDIO_DIR = "./Audio"
+VOICE_IDLE_TIMEOUT = config.get("voice_idle_timeout", 120)  # secondes sans lecture avant de quitter le vocal
+AUDIO_QUEUE_MAX = config.get("audio_queue_max", 20)  # lectures en attente par serveur
+AUDIO_QUEUE_MAX_PER_USER = config.get("audio_queue_max_per_user", 5)
+AUDIO_QUEUE_MAX_WAIT = config.get("audio_queue_max_wait", 300)  # secondes en file avant abandon
+AUDIO_CLIP_BURST = 3  # sons courts d'affilée max quand du TTS attend
+AUDIO_CLIP_ESTIMATE = 8.0  # durées estimées (s) pour l'ETA, si le manifeste ne les connaît pas
+AUDIO_TTS_ESTIMATE = 15.0
+AUDIO_MIN_PLAY_TIMEOUT = 30  # délai de lecture minimal, quelle que soit la durée
+AUDIO_PLAY_MARGIN = 10  # connexion vocale + démarrage de ffmpeg
+AUDIO_STREAM_LINGER_FRAMES = 25  # trames de 20 ms de silence avant de lâcher le lecteur
+AUDIO_PLAYER_STOP_WAIT = 2  # secondes max pour que le lecteur d'un flux fini rende la main
+OPUS_SILENCE = b"\xf8\xff\xfe"
+AUDIO_ETA_NOTIFY = 10  # on prévient l'utilisateur au-delà de cette attente
+TTS_CHARS_PER_SECOND = 14
 REDDIT_SUBREDDITS = ["darkjokes", "jokes", "dadjokes"]
 REDDIT_MAX_LENGTH = 350
 REDDIT_HEADERS = {"User-Agent": "Mozilla/5.0"}
+REDDIT_BASE_URL = config.get("reddit_base_url", "https://www.reddit.com")
+REDDIT_CORPUS_FILE = config.get("reddit_corpus_file", "reddit_jokes.json")
+REDDIT_FETCH_CONCURRENCY = config.get("reddit_fetch_concurrency", 4)  # requêtes Reddit simultanées
+REDDIT_REFRESH_INTERVAL = config.get("reddit_refresh_hours", 6) * 3600
+REDDIT_NEW_MAX_POSTS = 1000  # new.json ne remonte pas plus loin
+REDDIT_FOLLOWER_POLL = 30  # secondes, processus sans corpus qui attendent celui du leader
+JOKE_VOICE = "ash"
+JOKE_TTS_INSTRUCTIONS = "Read this joke with a comic tone, as if you are a stand-up comedian."
+JOKE_POOL_SIZE = config.get("joke_pool_size", 3)  # blagues prêtes à jouer par subreddit
+JOKE_POOL_REFILL_INTERVAL = 60
+JOKE_RANK_BIAS = 0.02
+JOKE_RECENT_SIZE = config.get("joke_recent_per_guild", 50)  # 0 = pas d'anti-répétition
+JOKE_RECENT_RETRIES = 5
 DEFAULT_GPT_PROMPT = config.get(
     "gpt_system_prompt",
     "You are a helpful assistant. Reply in the language in which the question is asked, either English or French."
@@ -30,13 +79,175 @@ DEFAULT_SAYVC_INSTRUCTIONS = config.get(
     "say_vc_instructions",
     "Utilise un accent québécois"
 )
-audio_files = [f for f in os.listdir(AUDIO_DIR) if f.endswith(".mp3")]
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.FileHandler("bot.log"), logging.StreamHandler()]
-)
+# ----- Sharding -----
+def _cli_value(flag, default=None):
+    """Value following flag on the command line (set by the shard launcher)."""
+    if flag in sys.argv:
+        i = sys.argv.index(flag)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+SHARD_COUNT = int(_cli_value("--shard-count", config.get("shard_count", 0))) or None  # None = nombre choisi par Discord
+SHARD_PROCESSES = int(_cli_value("--processes", config.get("shard_processes", 1)))  # 1 = tout dans ce processus
+SHARD_IDS = [int(s) for s in _cli_value("--shard-ids").split(",")] if _cli_value("--shard-ids") else None
+PROCESS_INDEX = int(_cli_value("--process-index", 0))
+SHARD_RESTART_DELAY = 5  # secondes, doublé à chaque plantage rapproché
+SHARD_RESTART_MAX_DELAY = 300
+SHARD_STABLE_AFTER = 600  # un processus qui a tenu 10 min repart avec le délai minimal
+SHARD_TAG = f"[shards {','.join(map(str, SHARD_IDS))}] " if SHARD_IDS else ""
+
+def owns_guild(guild_id):
+    """True if guild_id belongs to one of this process's shards (Discord's guild → shard formula)."""
+    if SHARD_IDS is None or SHARD_COUNT is None:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+class ProcessLock:
+    """Advisory file lock shared by the shard processes (flock; no-op without fcntl).
+
+    "with ProcessLock(path):" waits for the lock; try_acquire() takes it
+    without waiting and keeps it until release() or the process exits, which
+    is how one process is elected to do work the others must not duplicate.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None or fcntl is None
+
+    def try_acquire(self, blocking=False):
+        if self.held:
+            return True
+        f = open(self.path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.try_acquire(blocking=True)
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+# ----- Fin sharding -----
+
+# ----- Journalisation -----
+LOG_FILE = config.get("log_file", "bot.log")
+LOG_LEVEL = config.get("log_level", "INFO")
+LOG_JSON = config.get("log_json", True)  # une ligne JSON par enregistrement dans le fichier
+LOG_MAX_BYTES = int(config.get("log_max_mb", 10) * 1024 * 1024)
+LOG_BACKUP_COUNT = config.get("log_backup_count", 5)
+LOG_ROTATE_WHEN = config.get("log_rotate_when")  # ex. "midnight" : rotation horaire plutôt qu'à la taille
+LOG_QUEUE_MAX = 10000  # au-delà, les enregistrements sont perdus plutôt que de bloquer la boucle
+LOG_FIELDS = ("guild", "command", "user", "latency")
+LOG_TEXT_FORMAT = f"%(asctime)s [%(levelname)s] {SHARD_TAG}%(message)s"
+if SHARD_IDS:
+    # un fichier par processus : la rotation ne se partage pas entre processus
+    _log_base, _log_ext = os.path.splitext(LOG_FILE)
+    LOG_FILE = f"{_log_base}-{PROCESS_INDEX}{_log_ext}"
+
+log_context = contextvars.ContextVar("log_context", default=None)  # {"guild": ..., "command": ..., "user": ...}
+
+class LogContextFilter(logging.Filter):
+    """Stamps each record with the guild/command/user of the slash command being run.
+
+    Runs in the caller's context (before the queue), so records from any
+    coroutine or task started by a command carry its fields; explicit
+    extra={...} values win.
+    """
+
+    def filter(self, record):
+        ctx = log_context.get()
+        for field in LOG_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, ctx.get(field) if ctx else None)
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on a bounded queue; a full queue drops and counts instead of blocking."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # le message est figé ici (les arguments peuvent changer ensuite), le formatage final
+        # et l'écriture se font dans le thread du QueueListener
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, plus shards/guild/command/user/latency when known."""
+
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if SHARD_IDS:
+            data["shards"] = SHARD_IDS
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+def setup_logging():
+    """Route every record through a queue to one writer thread (rotating file + console)."""
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    file_handler.setFormatter(JsonLogFormatter() if LOG_JSON else logging.Formatter(LOG_TEXT_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(LOG_TEXT_FORMAT))
+    handler = LogQueueHandler(queue.Queue(LOG_QUEUE_MAX))
+    handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [handler]
+    listener = logging.handlers.QueueListener(
+        handler.queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
+
+log_handler = setup_logging()
+# ----- Fin journalisation -----
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -44,276 +255,2886 @@ intents.guilds = True
 intents.messages = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class JeanBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        # une seule fois par processus : les reconnexions au gateway ne repassent pas ici
+        await run_startup_phase("guild_state", guild_state.load())
+        await run_startup_phase("metrics", start_metrics_server())
+        self.warmup_task = asyncio.create_task(warmup())
+
+    async def close(self):
+        warmup_task = getattr(self, "warmup_task", None)
+        if warmup_task is not None:
+            warmup_task.cancel()
+        guild_state.stop()
+        await stop_metrics_server()
+        await close_http_session()
+        for pool in worker_pools:
+            pool.shutdown()
+        await super().close()
+
+bot = JeanBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+              activity=discord.Game(name="Tape /help"))
+
+reddit_jokes_by_sub = defaultdict(list)
+_corpus_saved_at = 0.0
+_corpus_mtime = None
+reddit_newest_post = {}  # subreddit: created_utc du post le plus récent déjà lu, filtré ou non
+_joke_cum_weights = {}  # subreddit: poids cumulés, recalculés à chaque chargement du corpus
+_recent_jokes = {}  # guild_id: OrderedDict des dernières blagues jouées
+_voice_schedulers = {}  # guild_id: GuildAudioScheduler
+_voice_queue_tasks = {}  # guild_id: tâche qui vide la file (reste connectée jusqu'au timeout d'inactivité)
+_gpt_flights = {}  # clé de requête: GPTFlight en cours
+_gpt_cache = OrderedDict()  # clé de requête: (expiration, réponse)
+gpt_stats = defaultdict(float)  # upstream, coalesced, cache_hits
+voice_stats = defaultdict(float)  # connects, moves, reuses, connect_seconds, play_seconds...
+_joke_pool = defaultdict(deque)  # subreddit: textes déjà dans le cache TTS
+_joke_pool_wakeup = None
+
+# ----- Historique commandes -----
+HISTORY_FILE = "command_history.json"  # ancien format, migré au premier démarrage
+HISTORY_DB = config.get("history_db", "command_history.db")
+HISTORY_RETENTION_DAYS = config.get("history_retention_days", 90)
+HISTORY_MAX_ENTRIES = config.get("history_max_entries", 100000)
+HISTORY_FLUSH_INTERVAL = 0.5  # secondes entre deux écritures groupées
+HISTORY_BATCH_SIZE = 200
+HISTORY_PRUNE_INTERVAL = 3600
+
+_HISTORY_STOP = object()
+
+class CommandHistoryStore:
+    """Command history in SQLite (WAL mode).
+
+    Slash commands only push entries on an in-memory queue; a background
+    thread writes them in batches and applies the retention policy, so the
+    event loop never touches the disk for logging. If the database cannot
+    be opened, the writer stops and later entries are dropped and counted.
+    """
+
+    def __init__(self, path, retention_days, max_entries):
+        self.path = path
+        self.retention_days = retention_days
+        self.max_entries = max_entries
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._local = threading.local()
+        self._failed = False
+        self.dropped = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS command_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT NOT NULL,
+                user_id INTEGER,
+                user TEXT,
+                command TEXT,
+                params TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_timestamp ON command_history(timestamp);
+            CREATE INDEX IF NOT EXISTS idx_history_user ON command_history(user_id, id);
+            CREATE INDEX IF NOT EXISTS idx_history_command ON command_history(command, id);
+        """)
+        return conn
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._writer, name="history-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_HISTORY_STOP)
+        self._thread.join(timeout=5)
+
+    def append(self, entry):
+        self.start()
+        if self._failed:
+            self.dropped += 1
+            return
+        self._queue.put(entry)
+
+    def recent(self, n=15, user_id=None, command=None):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        sql = "SELECT timestamp, user_id, user, command, params FROM command_history"
+        where, args = [], []
+        if user_id is not None:
+            where.append("user_id = ?")
+            args.append(user_id)
+        if command is not None:
+            where.append("command = ?")
+            args.append(command)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC LIMIT ?"
+        args.append(n)
+        rows = conn.execute(sql, args).fetchall()
+        return [
+            {
+                "timestamp": ts,
+                "user_id": uid,
+                "user": user,
+                "command": cmd,
+                "params": json.loads(params) if params else {}
+            }
+            for ts, uid, user, cmd, params in reversed(rows)
+        ]
+
+    def _writer(self):
+        try:
+            conn = self._connect()
+            self._migrate_json(conn)
+        except Exception as e:
+            logging.error(f"Command history store unavailable, entries will be dropped: {e}")
+            # plus personne ne vide la file : on la vide une fois et append() jette la suite
+            self._failed = True
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.dropped += 1
+            return
+        last_prune = 0.0
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                item = self._queue.get(timeout=HISTORY_FLUSH_INTERVAL)
+            except queue.Empty:
+                item = None
+            while item is not None:
+                if item is _HISTORY_STOP:
+                    stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= HISTORY_BATCH_SIZE:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            if batch:
+                self._write_batch(conn, batch)
+            if time.monotonic() - last_prune > HISTORY_PRUNE_INTERVAL:
+                self._prune(conn)
+                last_prune = time.monotonic()
+        conn.close()
+
+    def _write_batch(self, conn, batch):
+        try:
+            rows = [
+                (e["timestamp"], e.get("user_id"), e.get("user"), e.get("command"),
+                 json.dumps(e.get("params", {}), ensure_ascii=False, default=str))
+                for e in batch
+            ]
+            with conn:
+                conn.executemany(
+                    "INSERT INTO command_history (timestamp, user_id, user, command, params) "
+                    "VALUES (?, ?, ?, ?, ?)", rows)
+        except Exception as e:
+            logging.error("Error writing command history: %s", e)
+
+    def _prune(self, conn):
+        try:
+            with conn:
+                if self.retention_days:
+                    cutoff = (datetime.utcnow() - timedelta(days=self.retention_days)).isoformat(timespec="seconds")
+                    conn.execute("DELETE FROM command_history WHERE timestamp < ?", (cutoff,))
+                if self.max_entries:
+                    conn.execute(
+                        "DELETE FROM command_history WHERE id <= "
+                        "(SELECT MAX(id) FROM command_history) - ?", (self.max_entries,))
+        except Exception as e:
+            logging.error(f"Error pruning command history: {e}")
+
+    def _migrate_json(self, conn):
+        """Import the legacy command_history.json once, then rename it.
+
+        With several shard processes, only the one holding the lock imports;
+        the others find the file already renamed.
+        """
+        if not os.path.exists(HISTORY_FILE):
+            return
+        with ProcessLock(HISTORY_FILE + ".lock"):
+            try:
+                with open(HISTORY_FILE, "r", encoding="utf-8") as src:
+                    legacy = json.load(src)
+            except FileNotFoundError:
+                return  # migré par un autre processus
+            except Exception as e:
+                logging.warning(f"Legacy command history unreadable, skipped: {e}")
+                legacy = []
+            if legacy:
+                self._write_batch(conn, legacy)
+            os.replace(HISTORY_FILE, HISTORY_FILE + ".migrated")
+        logging.info(f"Migrated {len(legacy)} entries from {HISTORY_FILE} to {self.path}.")
+
+_history_store = CommandHistoryStore(HISTORY_DB, HISTORY_RETENTION_DAYS, HISTORY_MAX_ENTRIES)
+
+def log_command(user: discord.User, command_name: str, options: Dict[str, Any]):
+    entry = {
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+        "user_id": user.id,
+        "user": str(user),
+        "command": command_name,
+        "params": options
+    }
+    _history_store.append(entry)
+
+def get_recent_history(n=15):
+    try:
+        return _history_store.recent(n)
+    except Exception as e:
+        logging.error(f"Error reading command history: {e}")
+        return []
+
+def log_command_decorator(func):
+    @functools.wraps(func)
+    async def wrapper(interaction: discord.Interaction, *args, **kwargs):
+        # Récupère options/params sous forme d’un dict propre
+        param_names = func.__annotations__.keys()
+        resolved = {}
+        for k in param_names:
+            if k == "interaction":
+                continue
+            if k in kwargs:
+                v = kwargs[k]
+            elif args:
+                # essaye de deviner la position dans args
+                argidx = list(param_names).index(k) - 1
+                if argidx < len(args):
+                    v = args[argidx]
+                else:
+                    v = None
+            else:
+                v = None
+            # Si discord types (User, Channel...) => to string/preset
+            try:
+                if hasattr(v, "mention"):
+                    v = v.mention
+                elif hasattr(v, "name"):
+                    v = str(v.name)
+            except Exception:
+                pass
+            resolved[k] = v
+        if _first_command_at is None:
+            note_first_command()
+        log_command(interaction.user, func.__name__, resolved)
+        inc("jean_commands_total", command=func.__name__)
+        token = log_context.set({
+            "guild": interaction.guild.id if interaction.guild else None,
+            "command": func.__name__, "user": interaction.user.id})
+        start = time.monotonic()
+        try:
+            with timed("jean_command_seconds", command=func.__name__):
+                return await func(interaction, *args, **kwargs)
+        finally:
+            latency = time.monotonic() - start
+            logging.info("/%s handled in %.3fs", func.__name__, latency, extra={"latency": round(latency, 3)})
+            log_context.reset(token)
+    return wrapper
+# ----- Fin historique -----
+
+# ----- État des serveurs -----
+GUILD_STATE_DB = config.get("guild_state_db", "guild_state.db")
+GUILD_SETTING_TTL = 24 * 3600  # prompt /gpt et style /say-vc sauvegardés
+VC_BLOCK_DURATION = 2 * 3600
+
+class GuildStateStore:
+    """Per-guild settings and voice blocks in a SQLite file shared by all shard processes.
+
+    A guild is only served by the process owning its shard, so each process
+    reads its guilds' rows once at startup and then writes through; the
+    in-memory dicts stay authoritative and the file is what survives a
+    restart or a new shard layout. Expired rows are purged on load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS guild_settings (
+                    guild_id INTEGER NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL,
+                    PRIMARY KEY (guild_id, key)
+                );
+                CREATE TABLE IF NOT EXISTS vc_blocks (
+                    guild_id INTEGER NOT NULL,
+                    channel_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    until REAL NOT NULL,
+                    PRIMARY KEY (guild_id, channel_id, user_id)
+                );
+            """)
+            self._local.conn = conn
+        return conn
+
+    def load(self, now):
+        """Return (settings, blocks) rows still valid at now."""
+        self.purge_expired(now)
+        conn = self._conn()
+        settings = [
+            (gid, key, json.loads(value), expires_at)
+            for gid, key, value, expires_at in conn.execute(
+                "SELECT guild_id, key, value, expires_at FROM guild_settings")
+        ]
+        blocks = conn.execute("SELECT guild_id, channel_id, user_id, until FROM vc_blocks").fetchall()
+        return settings, blocks
+
+    def purge_expired(self, now):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM guild_settings WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            conn.execute("DELETE FROM vc_blocks WHERE until <= ?", (now,))
+
+    def set_setting(self, guild_id, key, value, expires_at=None):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO guild_settings (guild_id, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (guild_id, key, json.dumps(value, ensure_ascii=False), expires_at))
+
+    def delete_setting(self, guild_id, key):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM guild_settings WHERE guild_id = ? AND key = ?", (guild_id, key))
+
+    def set_block(self, guild_id, channel_id, user_id, until):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO vc_blocks (guild_id, channel_id, user_id, until) VALUES (?, ?, ?, ?)",
+                (guild_id, channel_id, user_id, until))
+
+    def delete_block(self, guild_id, channel_id, user_id):
+        with self._conn() as conn:
+            conn.execute(
+                "DELETE FROM vc_blocks WHERE guild_id = ? AND channel_id = ? AND user_id = ?",
+                (guild_id, channel_id, user_id))
+
+class GuildState:
+    """This process's guild settings and voice blocks, with expiry driven by one min-heap.
+
+    Every value with a deadline pushes (deadline, ...) on a heap; a single
+    sweeper task sleeps until the earliest deadline, drops what expired and
+    purges it from the store in one statement. Overwritten or deleted
+    values leave stale heap entries that are skipped when they come up, so
+    neither reads nor plays ever scan for expired entries.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._settings = {}  # (guild_id, key): (value, expires_at)
+        self._blocks = defaultdict(dict)  # (guild_id, channel_id): {user_id: until}
+        self._heap = []  # (deadline, seq, kind, key)
+        self._seq = itertools.count()
+        self._wakeup = None  # créé avec le sweeper, dans la boucle du bot
+        self._sweeper = None
+        self.expired = 0
+
+    def _schedule(self, deadline, kind, key):
+        heapq.heappush(self._heap, (deadline, next(self._seq), kind, key))
+        if self._wakeup is not None and self._heap[0][0] == deadline:
+            self._wakeup.set()
+
+    async def _persist(self, guild_id, method, *args):
+        if guild_id is not None:
+            await save_guild_state(method, guild_id, *args)
+
+    def get(self, guild_id, key, default=None):
+        entry = self._settings.get((guild_id, key))
+        return entry[0] if entry is not None else default
+
+    async def set(self, guild_id, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._settings[(guild_id, key)] = (value, expires_at)
+        if expires_at is not None:
+            self._schedule(expires_at, "setting", (guild_id, key))
+        await self._persist(guild_id, self.store.set_setting, key, value, expires_at)
+
+    async def delete(self, guild_id, key):
+        if self._settings.pop((guild_id, key), None) is not None:
+            await self._persist(guild_id, self.store.delete_setting, key)
+
+    async def block(self, guild_id, channel_id, user_id, duration):
+        until = time.time() + duration
+        self._blocks[(guild_id, channel_id)][user_id] = until
+        self._schedule(until, "block", (guild_id, channel_id, user_id))
+        await self._persist(guild_id, self.store.set_block, channel_id, user_id, until)
+
+    async def unblock(self, guild_id, channel_id, user_id):
+        """Remove a block; False if there was none."""
+        blocks = self._blocks.get((guild_id, channel_id))
+        if not blocks or blocks.pop(user_id, None) is None:
+            return False
+        if not blocks:
+            del self._blocks[(guild_id, channel_id)]
+        await self._persist(guild_id, self.store.delete_block, channel_id, user_id)
+        return True
+
+    def blockers(self, guild_id, channel_id, user_ids):
+        """Users of user_ids who currently block this voice channel."""
+        blocks = self._blocks.get((guild_id, channel_id))
+        if not blocks:
+            return []
+        now = time.time()
+        # le sweeper peut avoir quelques ms de retard : on revérifie l'échéance
+        return [uid for uid in user_ids if blocks.get(uid, 0) > now]
+
+    def _expire(self, now):
+        """Pop every due heap entry; returns how many live values it removed."""
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, kind, key = heapq.heappop(self._heap)
+            if kind == "setting":
+                entry = self._settings.get(key)
+                if entry is not None and entry[1] == deadline:
+                    del self._settings[key]
+                    removed += 1
+            else:
+                guild_id, channel_id, user_id = key
+                blocks = self._blocks.get((guild_id, channel_id))
+                if blocks and blocks.get(user_id) == deadline:
+                    del blocks[user_id]
+                    if not blocks:
+                        del self._blocks[(guild_id, channel_id)]
+                    removed += 1
+        return removed
+
+    async def _sweep(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.time()
+            removed = self._expire(now)
+            if removed:
+                self.expired += removed
+                await save_guild_state(self.store.purge_expired, now)
+
+    def start(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._wakeup = asyncio.Event()
+            self._sweeper = asyncio.create_task(self._sweep())
+
+    def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+    def stats(self):
+        return {
+            "settings": len(self._settings),
+            "blocks": sum(len(b) for b in self._blocks.values()),
+            "pending_deadlines": len(self._heap),
+            "expired": self.expired,
+        }
+
+    async def load(self):
+        """Restore this process's guilds from the store, then start the sweeper."""
+        now = time.time()
+        try:
+            settings, blocks = await disk_pool.run(self.store.load, now)
+        except sqlite3.Error as ex:
+            logging.error(f"Guild state store unavailable, starting with defaults: {ex}")
+            settings, blocks = [], []
+        restored = 0
+        for guild_id, key, value, expires_at in settings:
+            if owns_guild(guild_id):
+                self._settings[(guild_id, key)] = (value, expires_at)
+                if expires_at is not None:
+                    self._schedule(expires_at, "setting", (guild_id, key))
+                restored += 1
+        for guild_id, channel_id, user_id, until in blocks:
+            if owns_guild(guild_id):
+                self._blocks[(guild_id, channel_id)][user_id] = until
+                self._schedule(until, "block", (guild_id, channel_id, user_id))
+                restored += 1
+        logging.info(f"Guild state restored from {GUILD_STATE_DB}: {restored} entries.")
+        self.start()
+
+guild_state_store = GuildStateStore(GUILD_STATE_DB)
+guild_state = GuildState(guild_state_store)
+
+async def save_guild_state(method, *args, **kwargs):
+    """Run a GuildStateStore write off the event loop; the in-memory value stays if it fails."""
+    try:
+        await disk_pool.run(functools.partial(method, *args, **kwargs))
+    except sqlite3.Error as ex:
+        logging.warning("Guild state not persisted (%s): %s", method.__name__, ex)
+        count_error("guild_state", ex)
+# ----- Fin état des serveurs -----
+
+def get_voice_channel(interaction, specified: discord.VoiceChannel = None):
+    if interaction.user.voice and interaction.user.voice.channel:
+        return interaction.user.voice.channel
+    elif specified:
+        perms = specified.permissions_for(interaction.user)
+        if perms.connect and perms.speak:
+            return specified
+    return None
+
+# ----- Client HTTP partagé -----
+HTTP_MAX_CONNECTIONS = config.get("http_max_connections", 100)
+HTTP_MAX_CONNECTIONS_PER_HOST = config.get("http_max_connections_per_host", 20)
+HTTP_KEEPALIVE = 60
+_http_session = None
+
+def get_http_session():
+    """Shared aiohttp session (keep-alive pool) used by TTS, GPT and Reddit."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_MAX_CONNECTIONS,
+            limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=300
+        )
+        _http_session = aiohttp.ClientSession(connector=connector)
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+# ----- Fin client HTTP -----
+
+# ----- Métriques (format Prometheus) -----
+METRICS_HOST = config.get("metrics_host", "127.0.0.1")
+METRICS_PORT = config.get("metrics_port", 9108)  # 0 = pas d'endpoint /metrics
+if METRICS_PORT:
+    METRICS_PORT += PROCESS_INDEX  # un port par processus en mode multi-shard
+METRICS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+_metric_histograms = {}  # (nom, labels): Histogram
+_metric_counters = defaultdict(float)  # (nom, labels): total
+_metrics_runner = None
+
+class Histogram:
+    __slots__ = ("buckets", "total", "count")
+
+    def __init__(self):
+        self.buckets = [0] * len(METRICS_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(METRICS_BUCKETS, value)
+        if i < len(self.buckets):
+            self.buckets[i] += 1
+        self.total += value
+        self.count += 1
+
+def observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    hist = _metric_histograms.get(key)
+    if hist is None:
+        hist = _metric_histograms[key] = Histogram()
+    hist.observe(seconds)
+
+def inc(name, value=1, **labels):
+    _metric_counters[(name, tuple(sorted(labels.items())))] += value
+
+def count_error(component, error):
+    """error is an exception or a short code such as an HTTP status."""
+    kind = type(error).__name__ if isinstance(error, BaseException) else str(error)
+    inc("jean_errors_total", component=component, type=kind)
+
+class timed:
+    """with timed("jean_x_seconds", label=...): observes the block's wall time."""
+
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.monotonic() - self.start, **self.labels)
+        return False
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+def render_metrics():
+    lines = []
+    for (name, labels), hist in sorted(_metric_histograms.items()):
+        cumulative = 0
+        for bound, n in zip(METRICS_BUCKETS, hist.buckets):
+            cumulative += n
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist.count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {hist.total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+    for (name, labels), value in sorted(_metric_counters.items()):
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    # jauges calculées à la volée
+    for gid, scheduler in _voice_schedulers.items():
+        depth = len(scheduler) + (scheduler.current is not None)
+        lines.append(f'jean_audio_queue_depth{{guild="{gid}"}} {depth}')
+    lines.append(f"jean_voice_clients {len(bot.voice_clients)}")
+    for sub, jokes in reddit_jokes_by_sub.items():
+        lines.append(f'jean_reddit_corpus_jokes{{subreddit="{sub}"}} {len(jokes)}')
+    for sub, pool in _joke_pool.items():
+        lines.append(f'jean_joke_pool_ready{{subreddit="{sub}"}} {len(pool)}')
+    for key, value in tts_cache.stats().items():
+        lines.append(f"jean_tts_cache_{key} {value}")
+    for key, value in gpt_stats.items():
+        lines.append(f'jean_gpt_requests_total{{kind="{key}"}} {value}')
+    for key, value in voice_stats.items():
+        lines.append(f'jean_voice_stats{{stat="{key}"}} {value}')
+    for limiter in backend_limiters:
+        lines.append(f'jean_backend_active{{backend="{limiter.name}"}} {limiter.active}')
+        lines.append(f'jean_backend_waiting{{backend="{limiter.name}"}} {limiter.waiting}')
+        lines.append(f'jean_backend_limit{{backend="{limiter.name}"}} {limiter.limit}')
+        for key, value in limiter.stats.items():
+            lines.append(f'jean_backend_stats{{backend="{limiter.name}",stat="{key}"}} {value}')
+    for upstream in upstreams:
+        state = ("closed", "half_open", "open").index(upstream.breaker.state)
+        lines.append(f'jean_circuit_state{{backend="{upstream.name}"}} {state}')
+        for key, value in upstream.stats.items():
+            lines.append(f'jean_upstream_stats{{backend="{upstream.name}",stat="{key}"}} {value}')
+    lines.append(f"jean_audio_clips {len(audio_library.clips())}")
+    lines.append(f"jean_log_records_dropped_total {log_handler.dropped}")
+    lines.append(f"jean_history_entries_dropped_total {_history_store.dropped}")
+    for key, value in guild_state.stats().items():
+        lines.append(f'jean_guild_state{{stat="{key}"}} {value}')
+    for pool in worker_pools:
+        lines.append(f'jean_pool_pending{{pool="{pool.name}"}} {pool.pending}')
+        lines.append(f'jean_pool_workers{{pool="{pool.name}"}} {pool.workers}')
+        for key, value in pool.stats.items():
+            lines.append(f'jean_pool_stats{{pool="{pool.name}",stat="{key}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+async def _metrics_handler(request):
+    return web.Response(
+        body=render_metrics().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics_server():
+    global _metrics_runner
+    if not METRICS_PORT or _metrics_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as ex:
+        logging.error(f"Metrics endpoint unavailable on {METRICS_HOST}:{METRICS_PORT}: {ex}")
+        await runner.cleanup()
+        return
+    _metrics_runner = runner
+    logging.info(f"Metrics exposed on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global _metrics_runner
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+# ----- Fin métriques -----
+
+# ----- Pools de threads et limites par service -----
+TTS_MAX_CONCURRENCY = config.get("tts_max_concurrency", 8)  # appels TTS simultanés
+GPT_MAX_CONCURRENCY = config.get("gpt_max_concurrency", 8)
+BACKEND_QUEUE_MAX = config.get("backend_queue_max", 32)  # appels en attente d'un créneau, par service
+BACKEND_QUEUE_TIMEOUT = config.get("backend_queue_timeout", 10)  # secondes d'attente max d'un créneau
+
+class BackendBusy(Exception):
+    pass
+
+class BackendLimiter:
+    """Caps in-flight calls to one upstream and how long callers queue for a slot.
+
+    Waiting is a plain asyncio wait, so when a caller's wait_for expires its
+    queued call is dropped with it instead of running later for nobody.
+    """
+
+    def __init__(self, name, limit, max_queue=BACKEND_QUEUE_MAX, queue_timeout=BACKEND_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = None  # créé au premier acquire(), dans la boucle qui tourne (Python 3.9)
+        self.active = 0
+        self.waiting = 0
+        self.stats = defaultdict(float)  # calls, rejected, timeouts, cancelled, wait_seconds
+
+    async def acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise BackendBusy(f"{self.name}: {self.waiting} calls already waiting")
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise BackendBusy(f"{self.name}: no free slot after {self.queue_timeout}s")
+        except asyncio.CancelledError:
+            self.stats["cancelled"] += 1
+            raise
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - start
+        self.active += 1
+        self.stats["calls"] += 1
+        self.stats["wait_seconds"] += waited
+        observe("jean_backend_wait_seconds", waited, backend=self.name)
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+        return False
+
+class WorkerPool:
+    """Dedicated thread pool for one kind of blocking work, with saturation stats.
+
+    If the awaiting caller is cancelled before a thread picks the job up,
+    asyncio cancels the queued job as well.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix=f"jean-{name}")
+        self.pending = 0  # en file + en cours
+        self.stats = defaultdict(float)  # calls, cancelled, abandoned
+
+    async def run(self, fn, *args):
+        submitted = time.monotonic()
+        started = []
+
+        def call():
+            started.append(time.monotonic())
+            return fn(*args)
+
+        self.pending += 1
+        self.stats["calls"] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        except asyncio.CancelledError:
+            self.stats["abandoned" if started else "cancelled"] += 1
+            raise
+        finally:
+            self.pending -= 1
+            if started:
+                observe("jean_pool_wait_seconds", started[0] - submitted, pool=self.name)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+tts_limiter = BackendLimiter("tts", TTS_MAX_CONCURRENCY)
+gpt_limiter = BackendLimiter("gpt", GPT_MAX_CONCURRENCY)
+reddit_limiter = BackendLimiter("reddit", REDDIT_FETCH_CONCURRENCY)
+backend_limiters = (tts_limiter, gpt_limiter, reddit_limiter)
+reddit_pool = WorkerPool("reddit", 2)  # JSON des pages et instantané du corpus
+disk_pool = WorkerPool("disk", 4)  # écritures du cache TTS, lecture de l'historique
+build_pool = WorkerPool("build", 1)  # conversion Opus au démarrage, peut durer des minutes
+worker_pools = (reddit_pool, disk_pool, build_pool)
+# ----- Fin pools et limites -----
+
+# ----- Appels Azure : quota, reprises, disjoncteur -----
+TTS_RATE_PER_MINUTE = config.get("tts_rate_per_minute", 0)  # quota Azure, 0 = pas de limite côté client
+GPT_RATE_PER_MINUTE = config.get("gpt_rate_per_minute", 0)
+UPSTREAM_RETRIES = config.get("upstream_retries", 2)  # nouvelles tentatives après un 429/5xx/erreur réseau
+UPSTREAM_BACKOFF = 0.5  # base du délai exponentiel (avec jitter)
+UPSTREAM_MAX_RETRY_AFTER = 10  # au-delà, on abandonne au lieu d'attendre le Retry-After
+CIRCUIT_FAILURES = config.get("circuit_failures", 5)  # échecs d'affilée avant d'ouvrir le circuit
+CIRCUIT_COOLDOWN = config.get("circuit_cooldown", 30)
+TTS_HEDGE_AFTER = config.get("tts_hedge_after", 0)  # secondes avant un 2e appel TTS en parallèle, 0 = jamais
+
+class UpstreamError(Exception):
+    """Final failure of an Azure call; status is None for network errors."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class CircuitOpen(BackendBusy):
+    pass
+
+class TokenBucket:
+    """Client-side request quota; pause() also holds every caller after a 429."""
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1.0, rate_per_minute / 6)  # 10 secondes de quota en rafale
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def take(self, max_wait):
+        while True:
+            now = time.monotonic()
+            wait = self.paused_until - now
+            if wait <= 0 and self.rate:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+            if wait <= 0:
+                if self.rate:
+                    self.tokens -= 1
+                return
+            if wait > max_wait:
+                raise BackendBusy(f"quota exhausted for {wait:.1f}s")
+            max_wait -= wait
+            await asyncio.sleep(wait)
+
+class CircuitBreaker:
+    """Fail fast after CIRCUIT_FAILURES errors in a row; one probe call after the cooldown."""
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self._probing else "open"
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        if self._probing or time.monotonic() - self.opened_at < CIRCUIT_COOLDOWN:
+            raise CircuitOpen(f"{self.name}: circuit open")
+        self._probing = True
+
+    def success(self):
+        if self.opened_at is not None:
+            logging.info("%s: upstream back, circuit closed.", self.name)
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self._probing or (self.opened_at is None and self.failures >= CIRCUIT_FAILURES):
+            if not self._probing:
+                logging.warning("%s: %d failures in a row, circuit open for %ss.", self.name, self.failures, CIRCUIT_COOLDOWN)
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def abort(self):
+        """The call ended without telling us anything about the upstream."""
+        self._probing = False
+
+def _retry_after(headers):
+    for name, scale in (("retry-after-ms", 0.001), ("Retry-After", 1)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, ValueError):
+            continue
+    return None
+
+class Upstream:
+    """One Azure endpoint: quota bucket, circuit breaker and retries around a POST."""
+
+    def __init__(self, name, url_key, rate_per_minute):
+        self.name = name
+        self.url_key = url_key
+        self.bucket = TokenBucket(rate_per_minute)
+        self.breaker = CircuitBreaker(name)
+        self.stats = defaultdict(float)  # attempts, retries, throttled, hedged, hedge_wins
+
+    async def _post_once(self, payload, timeout):
+        await self.bucket.take(BACKEND_QUEUE_TIMEOUT)
+        self.breaker.check()
+        self.stats["attempts"] += 1
+        try:
+            return await get_http_session().post(
+                config[self.url_key],
+                headers={
+                    "api-key": config["api_key"],
+                    "Content-Type": "application/json"
+                },
+                json=payload,
+                timeout=timeout
+            )
+        except asyncio.CancelledError:
+            self.breaker.abort()
+            raise
+
+    async def _post_with_retries(self, payload, timeout):
+        for attempt in range(UPSTREAM_RETRIES + 1):
+            delay = random.uniform(0, UPSTREAM_BACKOFF * 2 ** attempt)
+            try:
+                resp = await self._post_once(payload, timeout)
+            except (asyncio.CancelledError, BackendBusy):
+                raise
+            except Exception as ex:
+                self.breaker.failure()
+                count_error(self.name, ex)
+                error = UpstreamError(repr(ex))
+            else:
+                if resp.status == 200:
+                    self.breaker.success()
+                    return resp
+                retry_after = _retry_after(resp.headers)
+                try:
+                    body = (await resp.text())[:200]
+                except Exception:
+                    body = ""
+                finally:
+                    resp.release()
+                count_error(self.name, f"http_{resp.status}")
+                error = UpstreamError(f"{resp.status} {body}", resp.status)
+                if resp.status == 429:
+                    # limité par Azure : tout le monde attend, pas seulement cet appel
+                    self.breaker.abort()
+                    self.stats["throttled"] += 1
+                    delay = retry_after if retry_after is not None else delay
+                    if delay > UPSTREAM_MAX_RETRY_AFTER:
+                        raise error
+                    self.bucket.pause(delay)
+                elif resp.status >= 500:
+                    self.breaker.failure()
+                    if retry_after is not None:
+                        delay = retry_after
+                else:
+                    self.breaker.success()  # 4xx : la requête est fautive, pas le service
+                    raise error
+            if attempt == UPSTREAM_RETRIES or delay > UPSTREAM_MAX_RETRY_AFTER:
+                raise error
+            self.stats["retries"] += 1
+            logging.info("%s: %s, retry %d/%d in %.1fs.", self.name, error, attempt + 1, UPSTREAM_RETRIES, delay)
+            await asyncio.sleep(delay)
+
+    async def post(self, payload, timeout, hedge_after=0):
+        """Return the 200 response (the caller releases it) or raise UpstreamError/BackendBusy.
+
+        With hedge_after, a second identical call starts if the first has not
+        answered by then; the first 200 wins and the other is dropped.
+        """
+        first = asyncio.create_task(self._post_with_retries(payload, timeout))
+        pending = {first}
+        try:
+            if hedge_after:
+                done, _ = await asyncio.wait(pending, timeout=hedge_after)
+                if not done:
+                    self.stats["hedged"] += 1
+                    pending.add(asyncio.create_task(self._post_with_retries(payload, timeout)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.stats["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_release_response)
+
+def _release_response(task):
+    if not task.cancelled() and task.exception() is None:
+        task.result().release()
+
+tts_upstream = Upstream("tts", "tts_url", TTS_RATE_PER_MINUTE)
+gpt_upstream = Upstream("gpt", "azure_gpt_url", GPT_RATE_PER_MINUTE)
+upstreams = (tts_upstream, gpt_upstream)
+# ----- Fin appels Azure -----
+
+class RedditJoke:
+    """Only what /joke needs from a Reddit post (a full child dict is ~100 fields)."""
+    __slots__ = ("name", "title", "selftext", "score", "created_utc", "subreddit")
+
+    def __init__(self, name, title, selftext, score, created_utc, subreddit):
+        self.name = name
+        self.title = title
+        self.selftext = selftext
+        self.score = score
+        self.created_utc = created_utc
+        self.subreddit = subreddit
+
+    @classmethod
+    def from_reddit(cls, d):
+        return cls(d.get("name"), d.get("title") or "", d.get("selftext") or "",
+                   d.get("score") or 0, d.get("created_utc") or 0, d.get("subreddit") or "")
+
+    @classmethod
+    def from_json(cls, item):
+        if isinstance(item, dict):  # ancien format {"data": {...}}
+            return cls.from_reddit(item["data"])
+        return cls(*item)
+
+    def to_json(self):
+        return [self.name, self.title, self.selftext, self.score, self.created_utc, self.subreddit]
+
+    @property
+    def text(self):
+        return f"{self.title}. {self.selftext}".strip()
+
+def _parse_reddit_page(raw):
+    data = json.loads(raw)["data"]
+    return [RedditJoke.from_reddit(c["data"]) for c in data.get("children", [])], data.get("after")
+
+async def fetch_reddit_listing(url, subreddit, headers, max_posts=1000, stop=None):
+    """Page through a listing; returns (posts, complete).
+
+    Pages are chained by the 'after' cursor, so they are fetched in order; the
+    parallelism is across subreddits (see load_reddit_jokes). stop(children)
+    ends the walk after a page; complete is False if a page failed.
+    """
+    session = get_http_session()
+    posts, after, complete = [], None, True
+    start = time.monotonic()
+    while len(posts) < max_posts:
+        page_url = url + (f"&after={after}" if after else "")
+        try:
+            async with reddit_limiter, \
+                    session.get(page_url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as r:
+                r.raise_for_status()
+                raw = await r.read()
+            # le gros dict de la page est construit et jeté hors de la boucle d'événements
+            children, after = await reddit_pool.run(_parse_reddit_page, raw)
+            del raw
+            if not children: break
+            posts.extend(children)
+            if not after or len(children) < 100: break
+            if stop is not None and stop(children): break
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            logging.warning(f"Reddit fetch error: {ex}")
+            count_error("reddit", ex)
+            complete = False
+            break
+    observe("jean_reddit_fetch_seconds", time.monotonic() - start, subreddit=subreddit)
+    return posts[:max_posts], complete
+
+async def fetch_reddit_top(subreddit, headers, max_posts=1000, window="year"):
+    """Best posts of the window, by score."""
+    url = f"{REDDIT_BASE_URL}/r/{subreddit}/top.json?t={window}&limit=1000"
+    posts, _ = await fetch_reddit_listing(url, subreddit, headers, max_posts)
+    return posts
+
+async def fetch_reddit_new(subreddit, headers, since, max_posts=REDDIT_NEW_MAX_POSTS):
+    """Posts created after since, from new.json; returns (posts, complete).
+
+    new.json is sorted by date, so the first page reaching since is the
+    last one needed (top.json is sorted by score: new posts sit deep in it).
+    """
+    url = f"{REDDIT_BASE_URL}/r/{subreddit}/new.json?limit=100"
+    return await fetch_reddit_listing(
+        url, subreddit, headers, max_posts,
+        stop=lambda children: any((c.created_utc or 0) <= since for c in children))
+
+async def load_reddit_jokes(previous=None):
+    """Fetch the corpus; with previous, only posts newer than the last fetch are merged in.
+
+    The increment reads new.json down to the newest post already fetched
+    (kept or filtered out), plus the first page of this week's top so the
+    scores of recent posts keep up.
+    """
+    logging.info("Refreshing Reddit jokes..." if previous else "Loading Reddit jokes...")
+    previous = previous or {}
+    start = time.monotonic()
+
+    async def fetch(sub):
+        key = sub.lower()
+        old_posts = previous.get(key, [])
+        if not old_posts:
+            posts = await fetch_reddit_top(sub, REDDIT_HEADERS, max_posts=1000)
+            complete = True
+        else:
+            since = reddit_newest_post.get(key) or max((p.created_utc or 0 for p in old_posts), default=0)
+            (posts, complete), rising = await asyncio.gather(
+                fetch_reddit_new(sub, REDDIT_HEADERS, since),
+                fetch_reddit_top(sub, REDDIT_HEADERS, max_posts=100, window="week"))
+            posts += rising
+        # le repère avance sur tout ce qui a été lu, blagues trop longues comprises,
+        # mais pas après une page en échec : les posts manqués seront relus au prochain tour
+        if posts and complete:
+            newest = max(p.created_utc or 0 for p in posts)
+            reddit_newest_post[key] = max(reddit_newest_post.get(key, 0), newest)
+        return posts
+
+    results = await asyncio.gather(*(fetch(sub) for sub in REDDIT_SUBREDDITS))
+    unique = defaultdict(list)
+    seen = set()
+    cutoff = time.time() - 365 * 86400  # même fenêtre que t=year
+    for sub, fresh in zip(REDDIT_SUBREDDITS, results):
+        merged = {p.name: p for p in previous.get(sub.lower(), [])}
+        for post in fresh:
+            merged[post.name] = post  # score à jour
+        posts = sorted(
+            (p for p in merged.values() if (p.created_utc or cutoff) >= cutoff),
+            key=lambda p: p.score, reverse=True)
+        for post in posts:
+            joke_text = post.text
+            k = joke_text.lower()
+            if 0 < len(joke_text) <= REDDIT_MAX_LENGTH and k not in seen:
+                unique[(post.subreddit or sub).lower()].append(post)
+                seen.add(k)
+    logging.info(
+        f"Loaded {sum(len(x) for x in unique.values())} jokes unique from Reddit "
+        f"in {time.monotonic() - start:.1f}s.")
+    return unique
+
+def load_joke_snapshot():
+    """Return (jokes, saved_at, newest_post) from the on-disk corpus, or (None, 0, {})."""
+    try:
+        with open(REDDIT_CORPUS_FILE, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        jokes = defaultdict(list, {
+            sub: [RedditJoke.from_json(item) for item in items]
+            for sub, items in snapshot["jokes"].items()
+        })
+        return jokes, snapshot.get("saved_at", 0), snapshot.get("newest_post", {})
+    except FileNotFoundError:
+        return None, 0, {}
+    except Exception as ex:
+        logging.warning(f"Reddit corpus snapshot unreadable, ignored: {ex}")
+        return None, 0, {}
+
+reddit_leader = ProcessLock(REDDIT_CORPUS_FILE + ".lock")
+
+def save_joke_snapshot(jokes, saved_at, newest_post=None):
+    tmp = REDDIT_CORPUS_FILE + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "saved_at": saved_at,
+                "newest_post": newest_post or {},
+                "jokes": {sub: [p.to_json() for p in posts] for sub, posts in jokes.items()}
+            }, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, REDDIT_CORPUS_FILE)
+    except OSError as ex:
+        logging.warning(f"Could not save Reddit corpus snapshot: {ex}")
+
+GPT_STREAMING = config.get("gpt_streaming", True)
+GPT_STREAM_TIMEOUT = 60
+GPT_EDIT_INTERVAL = 1.0  # secondes entre deux mises à jour de l'embed
+GPT_CACHE_TTL = config.get("gpt_cache_ttl", 120)  # secondes, 0 = pas de cache des réponses /gpt
+GPT_CACHE_MAX_ENTRIES = 256
+
+# ----- Cache TTS -----
+TTS_MODEL = "gpt-4o-mini-tts"
+TTS_SPEED = 1.0
+TTS_STREAMING = config.get("tts_streaming", True)  # lecture dès le premier morceau reçu
+TTS_CHUNKED_REPLIES = config.get("tts_chunked_replies", True)  # /gpt lu en entier, phrase par phrase
+TTS_CHUNK_MAX_CHARS = 300
+TTS_PARALLEL_CHUNKS = 3
+TTS_SEQUENCE_TIMEOUT = 300
+TTS_STREAM_MIN_CHARS = 120  # regroupement des phrases reçues en streaming
+TTS_CACHE_DIR = config.get("tts_cache_dir", "tts_cache")
+TTS_CACHE_MAX_BYTES = int(config.get("tts_cache_max_mb", 500) * 1024 * 1024)
+if SHARD_IDS:
+    # l'index LRU est en mémoire : chaque processus a son sous-dossier et sa part du plafond,
+    # sinon l'éviction de l'un supprimerait des fichiers que les autres croient encore avoir
+    TTS_CACHE_DIR = os.path.join(TTS_CACHE_DIR, f"p{PROCESS_INDEX}")
+    TTS_CACHE_MAX_BYTES //= max(1, SHARD_PROCESSES)
+TTS_CACHE_TTL = config.get("tts_cache_ttl_days", 30) * 86400
+TTS_CACHE_STATS_EVERY = 100  # log des compteurs toutes les N recherches
+
+class TTSCache:
+    """Content-addressed on-disk cache of synthesized MP3s.
+
+    Files are named after a hash of every parameter sent to the TTS API.
+    The file mtime is the last-use time, so the LRU order and TTL survive
+    restarts; the in-memory index is rebuilt from a directory scan.
+    The lock only guards the index: file writes, unlinks and the scan run
+    outside it, so a lookup never waits on disk I/O done for another call.
+    """
+
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key: (size, last_used), du plus ancien au plus récent
+        self._total = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()  # un seul scan du répertoire
+
+    @staticmethod
+    def key(text, voice, instructions, model=TTS_MODEL, speed=TTS_SPEED):
+        raw = json.dumps([text, voice, instructions, model, speed], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".mp3")
+
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                # un autre processus peut être en train d'écrire celui-ci
+                try:
+                    if os.path.getmtime(path) < time.time() - 3600:
+                        os.remove(path)
+                except OSError: pass
+                continue
+            if not name.endswith(".mp3"):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            found.append((st.st_mtime, name[:-4], st.st_size))
+        return found
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            found = self._scan()
+            with self._lock:
+                # ce que put() a ajouté pendant le scan est plus récent que tout le reste
+                entries = OrderedDict((key, (size, mtime)) for mtime, key, size in sorted(found))
+                entries.update(self._entries)
+                self._entries = entries
+                self._total = sum(size for size, _ in entries.values())
+                victims = self._evict_locked()
+                self._loaded = True
+            self._unlink(victims)
+        logging.info(f"TTS cache: {len(self._entries)} entries, {self._total // 1024} KiB in {self.directory}.")
+
+    def _remove_locked(self, key):
+        size, _ = self._entries.pop(key)
+        self._total -= size
+        return key
+
+    def _unlink(self, keys):
+        for key in keys:
+            try: os.remove(self._path(key))
+            except OSError: pass
+
+    def _evict_locked(self):
+        """Drop expired and over-budget entries from the index; returns the keys to unlink."""
+        now = time.time()
+        victims = []
+        if self.ttl:
+            # _entries est dans l'ordre d'utilisation : on s'arrête au premier encore frais
+            for k, (_, used) in self._entries.items():
+                if now - used <= self.ttl:
+                    break
+                victims.append(k)
+            for k in victims:
+                self._remove_locked(k)
+                self.evictions += 1
+        while self._entries and self._total > self.max_bytes:
+            victims.append(self._remove_locked(next(iter(self._entries))))
+            self.evictions += 1
+        return victims
+
+    def get(self, key):
+        """Return the cached file path for key, or None on a miss."""
+        self._ensure_loaded()
+        victims = []
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.time()
+            if entry is not None and self.ttl and now - entry[1] > self.ttl:
+                victims.append(self._remove_locked(key))
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                self._maybe_log_stats_locked()
+            else:
+                self._entries[key] = (entry[0], now)
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._maybe_log_stats_locked()
+        if entry is None:
+            self._unlink(victims)
+            return None
+        path = self._path(key)
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            # fichier disparu (évincé entre-temps) : l'index suit
+            with self._lock:
+                if key in self._entries:
+                    self._remove_locked(key)
+            return None
+        return path
+
+    def load(self):
+        """Scan the cache directory now rather than on the first lookup."""
+        self._ensure_loaded()
+
+    def contains(self, key):
+        """Like get() but without touching counters or LRU order."""
+        self._ensure_loaded()
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, data):
+        self._ensure_loaded()
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning("TTS cache write failed: %s", e)
+            try: os.remove(tmp)
+            except OSError: pass
+            return
+        with self._lock:
+            if key in self._entries:
+                self._total -= self._entries[key][0]
+            self._entries[key] = (len(data), time.time())
+            self._entries.move_to_end(key)
+            self._total += len(data)
+            victims = self._evict_locked()
+        self._unlink(victims)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
+
+    def _maybe_log_stats_locked(self):
+        lookups = self.hits + self.misses
+        if lookups % TTS_CACHE_STATS_EVERY == 0:
+            logging.info(
+                f"TTS cache stats: {self.hits} hits / {self.misses} misses "
+                f"({self.hits / lookups:.0%}), {len(self._entries)} entries, "
+                f"{self._total // 1024} KiB, {self.evictions} evictions")
+
+tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, TTS_CACHE_TTL)
+# ----- Fin cache TTS -----
+
+def _tts_payload(text, voice, instructions):
+    return {
+        "input": text,
+        "model": TTS_MODEL,
+        "voice": voice,
+        "response_format": "mp3",
+        "speed": TTS_SPEED,
+        "instructions": instructions
+    }
+
+async def _request_tts(text, voice, instructions):
+    start = time.monotonic()
+    try:
+        async with tts_limiter:
+            resp = await tts_upstream.post(
+                _tts_payload(text, voice, instructions), aiohttp.ClientTimeout(total=15),
+                hedge_after=TTS_HEDGE_AFTER)
+            async with resp:
+                data = await resp.read()
+        observe("jean_tts_seconds", time.monotonic() - start, mode="full")
+        return data
+    except asyncio.CancelledError:
+        raise
+    except BackendBusy as ex:
+        logging.warning("TTS busy: %s", ex)
+        count_error("tts", ex)
+        return None
+    except Exception as ex:
+        logging.error("TTS error: %r", ex)
+        return None
+
+class TTSStream:
+    """File-like object that FFmpeg reads from while the TTS body downloads.
+
+    The event loop feeds chunks as they arrive; FFmpeg's pipe-writer thread
+    blocks in read() until data (or the end of the stream) is available.
+    """
+
+    def __init__(self):
+        self._chunks = queue.Queue()
+        self._buffer = b""
+        self._eof = False
+        self._closed = False
+        self.task = None
+
+    def feed(self, data):
+        if data and not self._closed:
+            self._chunks.put(data)
+
+    def finish(self):
+        self._chunks.put(None)
+
+    def read(self, n=-1):
+        while not self._eof and (not self._buffer or n < 0):
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer += chunk
+        if n < 0 or n >= len(self._buffer):
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.task and not self.task.done():
+            self.task.cancel()
+        self.finish()
+
+async def _pump_tts(stream, resp, key):
+    parts = []
+    complete = False
+    try:
+        if TTS_STREAMING:
+            async for chunk in resp.content.iter_any():
+                parts.append(chunk)
+                stream.feed(chunk)
+        else:
+            data = await resp.read()
+            parts.append(data)
+            stream.feed(data)
+        complete = True
+    except asyncio.CancelledError:
+        raise
+    except Exception as ex:
+        logging.error("TTS stream interrupted: %r", ex)
+        count_error("tts", ex)
+    finally:
+        resp.release()
+        stream.finish()
+    if complete and parts:
+        await disk_pool.run(tts_cache.put, key, b"".join(parts))
+
+async def open_tts(text, voice, instructions):
+    """Return something play_audio can play for text, or None on TTS error.
+
+    A cache hit is the cached file path; otherwise a TTSStream that starts
+    receiving audio as soon as the TTS endpoint answers.
+    """
+    key = TTSCache.key(text, voice, instructions)
+    # utime du fichier, voire scan du répertoire au démarrage : hors de la boucle
+    cached = await disk_pool.run(tts_cache.get, key)
+    if cached:
+        return cached
+    start = time.monotonic()
+    try:
+        await tts_limiter.acquire()
+    except BackendBusy as ex:
+        logging.warning("TTS busy: %s", ex)
+        count_error("tts", ex)
+        return None
+    try:
+        resp = await tts_upstream.post(
+            _tts_payload(text, voice, instructions),
+            aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=15),
+            hedge_after=TTS_HEDGE_AFTER)
+    except asyncio.CancelledError:
+        tts_limiter.release()
+        raise
+    except BackendBusy as ex:
+        tts_limiter.release()
+        logging.warning("TTS busy: %s", ex)
+        count_error("tts", ex)
+        return None
+    except Exception as ex:
+        tts_limiter.release()
+        logging.error("TTS error: %r", ex)
+        return None
+    observe("jean_tts_seconds", time.monotonic() - start, mode="first_byte")
+    stream = TTSStream()
+    stream.task = asyncio.create_task(_pump_tts(stream, resp, key))
+    # le créneau reste pris jusqu'à la fin du flux, même si la tâche est annulée avant de démarrer
+    stream.task.add_done_callback(lambda _: tts_limiter.release())
+    return stream
+
+async def play_tts(interaction, text, voice, instructions, voice_channel):
+    """Synthesize text and play it in voice_channel through the guild queue."""
+    source = await asyncio.wait_for(open_tts(text, voice, instructions), timeout=20)
+    if source is None:
+        raise Exception("Erreur lors de la génération de la synthèse vocale.")
+    try:
+        await play_audio(interaction, source, voice_channel, estimate=len(text) / TTS_CHARS_PER_SECOND)
+    finally:
+        if isinstance(source, TTSStream):
+            source.close()
+
+# ----- TTS découpé en phrases -----
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+def split_sentences(text, max_len=None, short_first=True):
+    """Split text into speakable chunks of at most max_len characters.
+
+    The first chunk is kept short (unless short_first is False) so the first
+    audio arrives quickly; the following sentences are grouped up to
+    max_len to limit TTS calls.
+    """
+    max_len = max_len or TTS_CHUNK_MAX_CHARS
+    parts = []
+    for sentence in _SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        while len(sentence) > max_len:
+            cut = sentence.rfind(",", 0, max_len)
+            if cut <= 0:
+                cut = sentence.rfind(" ", 0, max_len)
+            if cut <= 0:
+                cut = max_len  # aucun séparateur : coupe franche
+            else:
+                cut += 1  # garde la virgule avec le morceau
+            parts.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            parts.append(sentence)
+    chunks = []
+    for part in parts:
+        if len(chunks) > (1 if short_first else 0) and len(chunks[-1]) + len(part) + 1 <= max_len:
+            chunks[-1] += " " + part
+        else:
+            chunks.append(part)
+    return chunks
+
+class SpeechSequence:
+    """File-like concatenation of TTS segments, read by a single FFmpeg process.
+
+    Segments (cached MP3 paths or TTSStreams) are added in playback order
+    from the event loop while FFmpeg's pipe-writer thread reads through them,
+    so chunk N+1 plays right after chunk N without restarting FFmpeg.
+    """
+
+    def __init__(self):
+        self._segments = queue.Queue()
+        self._current = None
+        self._eof = False
+        self._closed = False
+        self.count = 0
+        loop = asyncio.get_running_loop()
+        self.first_sentence = loop.create_future()  # premier texte reçu (GPT peut mettre du temps)
+        self.first_ready = loop.create_future()  # premier segment synthétisé
+        self.task = None
+
+    def sentence_received(self):
+        if not self.first_sentence.done():
+            self.first_sentence.set_result(True)
+
+    def add(self, source):
+        if self._closed:
+            if isinstance(source, TTSStream):
+                source.close()
+            return
+        self.count += 1
+        self._segments.put(source)
+        if not self.first_ready.done():
+            self.first_ready.set_result(True)
+
+    def finish(self):
+        self._segments.put(None)
+        if not self.first_sentence.done():
+            self.first_sentence.set_result(False)
+        if not self.first_ready.done():
+            self.first_ready.set_result(self.count > 0)
+
+    def read(self, n=-1):
+        while not self._eof:
+            if self._current is None:
+                segment = self._segments.get()
+                if segment is None:
+                    self._eof = True
+                    break
+                try:
+                    self._current = open(segment, "rb") if isinstance(segment, str) else segment
+                except OSError as ex:
+                    logging.warning("TTS segment unreadable, skipped: %s", ex)
+                    continue
+            data = self._current.read(n)
+            if data:
+                return data
+            self._current.close()
+            self._current = None
+        return b""
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.task and not self.task.done():
+            self.task.cancel()
+        while True:
+            try:
+                segment = self._segments.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(segment, TTSStream):
+                segment.close()
+        if isinstance(self._current, TTSStream):
+            self._current.close()
+        self.finish()
+
+async def _async_iter(items):
+    for item in items:
+        yield item
+
+async def _feed_sequence(seq, sentences, voice, instructions):
+    """Synthesize sentences a few at a time and add them to seq in order."""
+    semaphore = asyncio.Semaphore(TTS_PARALLEL_CHUNKS)
+    opened = asyncio.Queue()
+
+    async def open_one(text):
+        # la place est gardée jusqu'à la fin du téléchargement, pas seulement des en-têtes
+        await semaphore.acquire()
+        try:
+            source = await asyncio.wait_for(open_tts(text, voice, instructions), timeout=20)
+        except BaseException:
+            semaphore.release()
+            raise
+        if isinstance(source, TTSStream):
+            source.task.add_done_callback(lambda _task: semaphore.release())
+        else:
+            semaphore.release()
+        return source
+
+    async def produce():
+        try:
+            async for sentence in sentences:
+                seq.sentence_received()
+                await opened.put(asyncio.create_task(open_one(sentence)))
+        finally:
+            await opened.put(None)
+
+    producer = asyncio.create_task(produce())
+    pending = None
+    try:
+        while True:
+            pending = await opened.get()
+            if pending is None:
+                break
+            try:
+                source = await pending
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logging.warning("TTS chunk failed, skipped: %r", ex)
+                source = None
+            if source is not None:
+                seq.add(source)
+    finally:
+        producer.cancel()
+        while pending is not None:
+            pending.cancel()
+            try:
+                pending = opened.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        seq.finish()
+
+async def play_tts_chunks(interaction, sentences, voice, instructions, voice_channel):
+    """Play sentences (a list or an async iterator) as one gapless queue item.
+
+    Chunks are synthesized in parallel and playback starts as soon as the
+    first one is ready; the rest are streamed in order behind it.
+    """
+    if not hasattr(sentences, "__aiter__"):
+        sentences = _async_iter(sentences)
+    seq = SpeechSequence()
+    seq.task = asyncio.create_task(_feed_sequence(seq, sentences, voice, instructions))
+    try:
+        # GPT a son propre délai pour la première phrase ; les 20 s ne couvrent que la synthèse
+        await asyncio.wait_for(asyncio.shield(seq.first_sentence), timeout=GPT_STREAM_TIMEOUT)
+        if not await asyncio.wait_for(asyncio.shield(seq.first_ready), timeout=20):
+            raise Exception("Erreur lors de la génération de la synthèse vocale.")
+        await play_audio(interaction, seq, voice_channel, play_timeout=TTS_SEQUENCE_TIMEOUT)
+    finally:
+        seq.close()
+# ----- Fin TTS découpé -----
+
+async def warm_tts(text, voice, instructions):
+    """Make sure text is in the TTS cache without writing a playback file."""
+    key = TTSCache.key(text, voice, instructions)
+    if await disk_pool.run(tts_cache.contains, key):
+        return True
+    data = await _request_tts(text, voice, instructions)
+    if data is None:
+        return False
+    await disk_pool.run(tts_cache.put, key, data)
+    return True
+
+GPT_BUSY_MESSAGE = "Erreur : Azure OpenAI est débordé, réessaye dans un moment."
+
+class GPTError(Exception):
+    """Upstream GPT failure; str(exc) is the French message shown to users."""
+
+def _gpt_payload(query, system_prompt, stream=False):
+    payload = {
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": query}
+        ],
+        "max_tokens": 400
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+def _gpt_error(ex):
+    """Log an upstream failure and turn it into the GPTError shown to users."""
+    if isinstance(ex, BackendBusy):
+        logging.warning("GPT busy: %s", ex)
+        count_error("gpt", ex)
+        return GPTError(GPT_BUSY_MESSAGE)
+    if isinstance(ex, UpstreamError) and ex.status:
+        logging.error("GPT error: %s", ex)
+        return GPTError("Erreur : la réponse d'Azure OpenAI a échoué.")
+    logging.error("GPT network error: %r", ex)
+    if not isinstance(ex, UpstreamError):  # déjà compté par Upstream
+        count_error("gpt", ex)
+    return GPTError("Erreur : impossible de contacter Azure OpenAI.")
+
+async def _complete_gpt(query, system_prompt):
+    start = time.monotonic()
+    try:
+        async with gpt_limiter:
+            resp = await gpt_upstream.post(_gpt_payload(query, system_prompt), aiohttp.ClientTimeout(total=20))
+            async with resp:
+                reply = (await resp.json())["choices"][0]["message"]["content"].strip()
+        observe("jean_gpt_seconds", time.monotonic() - start, mode="full")
+        return reply
+    except asyncio.CancelledError:
+        raise
+    except Exception as ex:
+        raise _gpt_error(ex)
+
+# ----- GPT en streaming -----
+async def _stream_gpt_upstream(query, system_prompt):
+    """Yield the completion piece by piece from Azure's SSE stream; raise GPTError."""
+    if not GPT_STREAMING:
+        yield await _complete_gpt(query, system_prompt)
+        return
+    try:
+        await gpt_limiter.acquire()
+    except BackendBusy as ex:
+        raise _gpt_error(ex)
+    try:
+        start = time.monotonic()
+        try:
+            resp = await gpt_upstream.post(
+                _gpt_payload(query, system_prompt, stream=True),
+                aiohttp.ClientTimeout(total=GPT_STREAM_TIMEOUT, sock_read=20))
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            raise _gpt_error(ex)
+        async with resp:
+            first = True
+            try:
+                async for raw in resp.content:
+                    line = raw.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(payload)
+                    except ValueError:
+                        continue
+                    for choice in chunk.get("choices") or []:
+                        delta = (choice.get("delta") or {}).get("content")
+                        if delta:
+                            if first:
+                                observe("jean_gpt_seconds", time.monotonic() - start, mode="first_token")
+                                first = False
+                            yield delta
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logging.error("GPT stream interrupted: %r", ex)
+                count_error("gpt", ex)
+                raise GPTError("Erreur : la réponse d'Azure OpenAI a été interrompue.")
+    finally:
+        gpt_limiter.release()
+
+class GPTFlight:
+    """One upstream completion shared by every identical concurrent request.
+
+    The upstream call runs in its own task, so a subscriber that gives up
+    does not cancel it for the others; each subscriber replays the parts
+    received so far, then follows the live stream.
+    """
+
+    def __init__(self, key, query, system_prompt, cache):
+        self.key = key
+        self.parts = []
+        self.done = False
+        self.failed = False
+        self._cond = asyncio.Condition()
+        self.task = asyncio.create_task(self._run(query, system_prompt, cache))
+
+    async def _run(self, query, system_prompt, cache):
+        try:
+            async for delta in _stream_gpt_upstream(query, system_prompt):
+                await self._publish(delta)
+        except GPTError as ex:
+            self.failed = True
+            if not self.parts:
+                await self._publish(str(ex))
+        except BaseException:
+            self.failed = True
+            raise
+        finally:
+            # cache rempli avant de retirer le vol : aucune requête ne passe entre les deux
+            if cache and not self.failed and GPT_CACHE_TTL:
+                _gpt_cache[self.key] = (time.monotonic() + GPT_CACHE_TTL, "".join(self.parts))
+                _gpt_cache.move_to_end(self.key)
+                while len(_gpt_cache) > GPT_CACHE_MAX_ENTRIES:
+                    _gpt_cache.popitem(last=False)
+            _gpt_flights.pop(self.key, None)
+            async with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    async def _publish(self, delta):
+        async with self._cond:
+            self.parts.append(delta)
+            self._cond.notify_all()
+
+    async def subscribe(self):
+        i = 0
+        while True:
+            while i < len(self.parts):
+                yield self.parts[i]
+                i += 1
+            if self.done:
+                return
+            async with self._cond:
+                await self._cond.wait_for(lambda: self.done or len(self.parts) > i)
+
+def _gpt_key(query, system_prompt):
+    raw = json.dumps([config["azure_gpt_url"], system_prompt, query, 400, GPT_STREAMING], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+async def stream_gpt(query, system_prompt, cache=False):
+    """Yield the reply piece by piece, sharing identical in-flight requests.
+
+    With cache=True a recent identical reply (GPT_CACHE_TTL) is returned
+    without calling Azure. Errors are yielded as their French GPTError
+    message, so callers can display them like any reply.
+    """
+    key = _gpt_key(query, system_prompt)
+    cached = _gpt_cache.get(key) if cache else None
+    if cached and cached[0] > time.monotonic():
+        gpt_stats["cache_hits"] += 1
+        yield cached[1]
+        return
+    flight = _gpt_flights.get(key)
+    if flight is None:
+        gpt_stats["upstream"] += 1
+        flight = _gpt_flights[key] = GPTFlight(key, query, system_prompt, cache)
+    else:
+        gpt_stats["coalesced"] += 1
+        logging.info("GPT request coalesced with an identical in-flight call (%.0f so far).", gpt_stats["coalesced"])
+    async for delta in flight.subscribe():
+        yield delta
+
+class SentenceFeed:
+    """Turns streamed text into TTS chunks as soon as sentences complete.
+
+    The first sentence is released alone for a fast start; later ones are
+    grouped until TTS_STREAM_MIN_CHARS so long answers do not become
+    dozens of tiny TTS calls.
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._buffer = ""
+        self._pending = ""
+        self._first = True
+
+    def push(self, delta):
+        self._buffer += delta
+        last = None
+        for last in _SENTENCE_END.finditer(self._buffer):
+            pass
+        if last is None:
+            return
+        complete, self._buffer = self._buffer[:last.start()], self._buffer[last.end():]
+        self._emit(complete)
+
+    def _emit(self, text, final=False):
+        self._pending = f"{self._pending} {text}".strip()
+        if self._pending and (self._first or final or len(self._pending) >= TTS_STREAM_MIN_CHARS):
+            for chunk in split_sentences(self._pending, short_first=self._first):
+                self._queue.put_nowait(chunk)
+            self._pending = ""
+            self._first = False
+
+    def close(self):
+        self._emit(self._buffer, final=True)
+        self._buffer = ""
+        self._queue.put_nowait(None)
+
+    async def sentences(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is None:
+                return
+            yield chunk
+
+async def stream_gpt_reply(interaction, query, system_prompt, render, voice_channel=None, instructions=None,
+                           cache=False):
+    """Stream a GPT answer into the deferred response, editing it as text arrives.
+
+    render(text) builds the embed. With voice_channel, TTS starts on the
+    first complete sentence; the playback task is returned with the text.
+    """
+    feed = SentenceFeed() if voice_channel else None
+    speech = None
+    if feed:
+        speech = asyncio.create_task(
+            play_tts_chunks(interaction, feed.sentences(), "ash", instructions, voice_channel))
+    text = ""
+    last_edit = 0.0
+    edit_task = None
+    try:
+        async for delta in stream_gpt(query, system_prompt, cache=cache):
+            text += delta
+            if feed:
+                feed.push(delta)
+            now = time.monotonic()
+            if now - last_edit >= GPT_EDIT_INTERVAL and (edit_task is None or edit_task.done()):
+                last_edit = now
+                edit_task = asyncio.create_task(interaction.edit_original_response(embed=render(text + " …")))
+    except BaseException:
+        if speech:
+            speech.cancel()
+        raise
+    finally:
+        if feed:
+            feed.close()
+        if edit_task:
+            try:
+                await edit_task
+            except Exception:
+                pass
+    await interaction.edit_original_response(embed=render(text.strip()))
+    return text.strip(), speech
+# ----- Fin GPT en streaming -----
+
+# ----- Bibliothèque audio -----
+OPUS_CACHE_DIR = config.get("opus_cache_dir", os.path.join(AUDIO_DIR, ".opus"))
+OPUS_BITRATE = "96k"
+OPUS_BUILD_WORKERS = 2
+AUDIO_RESCAN_INTERVAL = config.get("audio_rescan_seconds", 60)  # détection des sons ajoutés/modifiés
+_FFMPEG_DURATION = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+_FFMPEG_LOUDNESS = re.compile(r"I:\s+(-?\d+(?:\.\d+)?) LUFS")
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _probe_audio(path):
+    """(duration in seconds, integrated loudness in LUFS) from one ffmpeg ebur128 pass."""
+    cmd = [
+        "ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-i", path,
+        "-vn", "-af", "ebur128=framelog=quiet", "-f", "null", "-"
+    ]
+    out = subprocess.run(cmd, check=True, capture_output=True, timeout=120).stderr.decode("utf-8", "replace")
+    m = _FFMPEG_DURATION.search(out)
+    duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3)) if m else None
+    loudness = _FFMPEG_LOUDNESS.findall(out)
+    return duration, float(loudness[-1]) if loudness else None
+
+class AudioLibrary:
+    """Manifest of the MP3 clips in AUDIO_DIR, with Discord-ready Opus copies.
+
+    Each clip is recorded with its mtime, size, sha256, duration and
+    loudness, and transcoded once by ffmpeg to Ogg/Opus (48 kHz stereo,
+    20 ms frames). build() is incremental and cheap when nothing changed,
+    so it is simply re-run on a timer to pick up new clips. Byte-identical
+    clips are kept once in the random pool.
+    """
+
+    def __init__(self, source_dir, cache_dir):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self._entries = {}
+        self._clips = []
+        self._lock = threading.Lock()
+        self._ffmpeg = True
+        self._built = False
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
 
-_guild_gpt_prompt = defaultdict(lambda: DEFAULT_GPT_PROMPT)
-_guild_sayvc_instructions = defaultdict(lambda: DEFAULT_SAYVC_INSTRUCTIONS)
-_guild_gpt_prompt_reset_task = {}
-_guild_sayvc_reset_task = {}
-reddit_jokes_by_sub = defaultdict(list)
-_voice_audio_queues = defaultdict(asyncio.Queue)
-_voice_locks = defaultdict(asyncio.Lock)
-_vc_blocks = defaultdict(dict)  # (guild_id, channel_id): {user_id: until_ts}
+    def _save_manifest(self, entries):
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.manifest_path)
 
-# ----- Historique commandes -----
-HISTORY_FILE = "command_history.json"
-_history_lock = threading.Lock()
+    def _opus_name(self, name):
+        return os.path.splitext(name)[0] + ".ogg"
 
-def log_command(user: discord.User, command_name: str, options: Dict[str, Any]):
-    entry = {
-        "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
-        "user_id": user.id,
-        "user": str(user),
-        "command": command_name,
-        "params": options
-    }
-    with _history_lock:
-        try:
-            if os.path.exists(HISTORY_FILE):
-                with open(HISTORY_FILE, "r", encoding="utf-8") as src:
-                    history = json.load(src)
+    def _transcode(self, src, dst):
+        tmp = dst + ".tmp"
+        cmd = [
+            "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+            "-i", src, "-vn", "-map_metadata", "-1",
+            "-c:a", "libopus", "-b:a", OPUS_BITRATE, "-ar", "48000", "-ac", "2",
+            "-frame_duration", "20", "-application", "audio",
+            "-f", "ogg", tmp
+        ]
+        subprocess.run(cmd, check=True, capture_output=True, timeout=120)
+        os.replace(tmp, dst)
+
+    def _build_one(self, name, old):
+        """Return (entry, work_done) for one clip; ffmpeg only runs for new content."""
+        src = os.path.join(self.source_dir, name)
+        st = os.stat(src)
+        if old and old["mtime"] == st.st_mtime and old["size"] == st.st_size:
+            entry = dict(old)
+        else:
+            digest = _file_sha256(src)
+            if old and old["sha256"] == digest:
+                entry = dict(old, mtime=st.st_mtime, size=st.st_size)
             else:
-                history = []
-        except Exception:
-            history = []
-        history.append(entry)
+                entry = {"mtime": st.st_mtime, "size": st.st_size, "sha256": digest, "opus": None}
+        entry.pop("duplicate_of", None)
+        fresh = "duration" not in entry  # nouveau contenu, ou manifeste d'avant les durées
+        dst = os.path.join(self.cache_dir, self._opus_name(name))
+        missing_opus = entry["opus"] is not None and not os.path.exists(dst)
+        work = False
+        if not self._ffmpeg or not (fresh or missing_opus):
+            return entry, work
         try:
-            with open(HISTORY_FILE, "w", encoding="utf-8") as out:
-                json.dump(history, out, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logging.error(f"Error writing command history: {e}")
+            if fresh:
+                try:
+                    entry["duration"], entry["loudness"] = _probe_audio(src)
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as ex:
+                    logging.warning(f"Audio probe failed for {name}: {ex}")
+                    entry["duration"] = entry["loudness"] = None
+                work = True
+            if (fresh and entry["opus"] is None) or missing_opus:
+                try:
+                    self._transcode(src, dst)
+                    entry["opus"] = self._opus_name(name)
+                except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as ex:
+                    logging.warning(f"Opus transcode failed for {name}: {ex}")
+                    entry["opus"] = None
+                work = True
+        except FileNotFoundError as ex:
+            if ex.filename != "ffmpeg":
+                raise
+            if self._ffmpeg:
+                self._ffmpeg = False
+                logging.warning("ffmpeg not found, clips indexed without Opus copies, durations or loudness.")
+            entry.pop("duration", None)
+        return entry, work
 
-def get_recent_history(n=15):
-    with _history_lock:
+    def build(self):
+        """Index new or changed clips and drop deleted ones; safe to call again at any time."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # les processus d'un déploiement multi-shard partagent le cache : un seul construit à la fois
+        with ProcessLock(os.path.join(self.cache_dir, ".build.lock")):
+            self._build()
+
+    def _build(self):
+        with self._lock:
+            old_entries = dict(self._entries)
+        if not old_entries:
+            old_entries = self._load_manifest()
+            with self._lock:
+                # copies déjà prêtes utilisables pendant la reconstruction
+                self._entries = {n: e for n, e in old_entries.items()
+                                 if e.get("opus") and os.path.exists(os.path.join(self.cache_dir, e["opus"]))}
+        names = [f for f in os.listdir(self.source_dir) if f.endswith(".mp3")]
+        entries, worked, failed = {}, 0, 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=OPUS_BUILD_WORKERS) as pool:
+            futures = {pool.submit(self._build_one, name, old_entries.get(name)): name for name in names}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    entry, work = future.result()
+                except Exception as ex:
+                    logging.warning(f"Audio indexing failed for {name}: {ex}")
+                    failed += 1
+                    continue
+                worked += work
+                entries[name] = entry
+        removed = [name for name in old_entries if name not in entries]
+        for name in removed:
+            opus = old_entries[name].get("opus")
+            if opus:
+                try: os.remove(os.path.join(self.cache_dir, opus))
+                except OSError: pass
+        by_hash = defaultdict(list)
+        for name in sorted(entries):
+            by_hash[entries[name]["sha256"]].append(name)
+        for same in by_hash.values():
+            for name in same[1:]:
+                entries[name]["duplicate_of"] = same[0]
+        changed = entries != old_entries
+        if changed:
+            self._save_manifest(entries)
+        with self._lock:
+            self._entries = entries
+            self._clips = sorted(by_hash[digest][0] for digest in by_hash)
+        if changed or not self._built:
+            duplicates = len(entries) - len(by_hash)
+            logging.info(
+                f"Audio library ready: {len(self._clips)} clips ({duplicates} duplicates skipped, "
+                f"{worked} processed, {len(removed)} removed, {failed} failed).")
+        self._built = True
+
+    def _entry(self, path):
+        """Manifest entry for an AUDIO_DIR clip if it matches the file on disk, else None."""
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.source_dir):
+            return None
+        with self._lock:
+            entry = self._entries.get(os.path.basename(path))
+        if not entry:
+            return None
         try:
-            if not os.path.exists(HISTORY_FILE):
-                return []
-            with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-                items = json.load(f)
-        except Exception as e:
-            logging.error(f"Error reading command history: {e}")
-            return []
-    return items[-n:] if len(items) > n else items
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_mtime != entry["mtime"] or st.st_size != entry["size"]:
+            return None
+        return entry
 
-def log_command_decorator(func):
-    async def wrapper(interaction: discord.Interaction, *args, **kwargs):
-        # Récupère options/params sous forme d’un dict propre
-        param_names = func.__annotations__.keys()
-        resolved = {}
-        for k in param_names:
-            if k == "interaction":
-                continue
-            if k in kwargs:
-                v = kwargs[k]
-            elif args:
-                # essaye de deviner la position dans args
-                argidx = list(param_names).index(k) - 1
-                if argidx < len(args):
-                    v = args[argidx]
-                else:
-                    v = None
-            else:
-                v = None
-            # Si discord types (User, Channel...) => to string/preset
-            try:
-                if hasattr(v, "mention"):
-                    v = v.mention
-                elif hasattr(v, "name"):
-                    v = str(v.name)
-            except Exception:
-                pass
-            resolved[k] = v
-        log_command(interaction.user, func.__name__, resolved)
-        return await func(interaction, *args, **kwargs)
-    wrapper.__name__ = func.__name__
-    return wrapper
-# ----- Fin historique -----
+    def path_for(self, path):
+        """Return the Opus copy of an AUDIO_DIR clip if it is up to date, else None."""
+        entry = self._entry(path)
+        if not entry or not entry.get("opus"):
+            return None
+        return os.path.join(self.cache_dir, entry["opus"])
 
-def is_vc_blocked_for_user(guild_id, channel_id, user_list):
-    """Return list of users in user_list that block this VC (clean expired first)."""
-    now = time.time()
-    blocks = _vc_blocks[(guild_id, channel_id)]
-    expired = [uid for uid, until in blocks.items() if until < now]
-    for uid in expired:
-        del blocks[uid]
-    return list(set(blocks.keys()) & set(user_list))
+    def duration(self, path):
+        entry = self._entry(path)
+        return entry.get("duration") if entry else None
 
-def get_voice_channel(interaction, specified: discord.VoiceChannel = None):
-    if interaction.user.voice and interaction.user.voice.channel:
-        return interaction.user.voice.channel
-    elif specified:
-        perms = specified.permissions_for(interaction.user)
-        if perms.connect and perms.speak:
-            return specified
-    return None
+    def clips(self):
+        """Distinct clip names; a plain listing until the first build is done."""
+        with self._lock:
+            clips = list(self._clips)
+        return clips or [f for f in os.listdir(self.source_dir) if f.endswith(".mp3")]
 
-async def fetch_reddit_top(subreddit, headers, max_posts=1000):
-    url = f"https://www.reddit.com/r/{subreddit}/top.json?t=year&limit=1000"
-    loop = asyncio.get_event_loop()
-    def fetch():
-        posts, after = [], None
-        while len(posts) < max_posts:
-            page_url = url + (f"&after={after}" if after else "")
-            try:
-                r = requests.get(page_url, headers=headers, timeout=10)
-                r.raise_for_status()
-                data = r.json()["data"]
-                children = data.get("children", [])
-                if not children: break
-                posts.extend(children)
-                after = data.get("after")
-                if not after or len(children) < 100: break
-            except Exception as ex:
-                logging.warning(f"Reddit fetch error: {ex}")
-                break
-        return posts[:max_posts]
-    return await loop.run_in_executor(None, fetch)
+    def pick(self):
+        clips = self.clips()
+        return random.choice(clips) if clips else None
 
-async def load_reddit_jokes():
-    logging.info("Loading Reddit jokes...")
-    unique = defaultdict(list)
-    seen = set()
-    for sub in REDDIT_SUBREDDITS:
-        posts = await fetch_reddit_top(sub, REDDIT_HEADERS, max_posts=1000)
-        for post in posts:
-            d = post["data"]
-            joke_text = f"{d.get('title','')}. {d.get('selftext','')}".strip()
-            k = joke_text.lower()
-            if 0 < len(joke_text) <= REDDIT_MAX_LENGTH and k not in seen:
-                unique[d.get('subreddit', sub).lower()].append(post)
-                seen.add(k)
-    logging.info(f"Loaded {sum(len(x) for x in unique.values())} jokes unique from Reddit.")
-    return unique
+class OpusFileAudio(discord.AudioSource):
+    """Sends the packets of an Ogg/Opus file as-is: no ffmpeg, no re-encoding."""
 
-def run_tts(joke_text, filename, voice, instructions):
-    try:
-        resp = requests.post(
-            config["tts_url"],
-            headers={
-                "api-key": config["api_key"],
-                "Content-Type": "application/json"
-            },
-            json={
-                "input": joke_text,
-                "model": "gpt-4o-mini-tts",
-                "voice": voice,
-                "response_format": "mp3",
-                "speed": 1.0,
-                "instructions": instructions
-            },
-            timeout=15
-        )
-        if resp.status_code == 200:
-            with open(filename, "wb") as f: f.write(resp.content)
-            return True
-        else:
-            logging.error(f"TTS error: {resp.status_code} {resp.text}")
-            return False
-    except Exception as ex:
-        logging.error(f"TTS network error: {ex}")
-        return False
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._packets = OggStream(self._file).iter_packets()
 
-def run_gpt(query, system_prompt):
-    try:
-        resp = requests.post(
-            config["azure_gpt_url"],
-            headers={
-                "api-key": config["api_key"],
-                "Content-Type": "application/json"
-            },
-            json={
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query}
-                ],
-                "max_tokens": 400
-            },
-            timeout=20
-        )
-        if resp.status_code == 200:
-            return resp.json()["choices"][0]["message"]["content"].strip()
+    def read(self):
+        return next(self._packets, b"")
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+audio_library = AudioLibrary(AUDIO_DIR, OPUS_CACHE_DIR)
+# ----- Fin bibliothèque audio -----
+
+# ----- File audio par serveur -----
+AUDIO_LANE_CLIP = 0  # sons courts de ./Audio
+AUDIO_LANE_TTS = 1  # synthèses vocales, souvent plus longues
+
+class AudioRequest:
+    __slots__ = ("source", "user_id", "lane", "estimate", "voice_channel", "interaction",
+                 "started", "done", "enqueued_at")
+
+    def __init__(self, source, user_id, lane, estimate, voice_channel, interaction):
+        loop = asyncio.get_running_loop()
+        self.source = source
+        self.user_id = user_id
+        self.lane = lane
+        self.estimate = estimate
+        self.voice_channel = voice_channel
+        self.interaction = interaction
+        self.started = loop.create_future()
+        self.done = loop.create_future()
+        self.enqueued_at = time.monotonic()
+
+class GuildAudioScheduler:
+    """Per-guild playback queue with priority lanes and per-user round-robin.
+
+    Short clips go first, but never more than AUDIO_CLIP_BURST in a row
+    while TTS is waiting. Inside a lane, users take turns, so one person
+    spamming /say-vc only delays their own items.
+    """
+
+    def __init__(self):
+        self._lanes = (OrderedDict(), OrderedDict())  # lane: {user_id: deque de requêtes}
+        self._size = 0
+        self._clip_streak = 0
+        self._wakeup = asyncio.Event()
+        self.current = None
+        self.current_started = 0.0
+        self.prefetched = None  # retiré de la file, prêt à enchaîner après current
+
+    def __len__(self):
+        return self._size
+
+    def put(self, req):
+        if self._size >= AUDIO_QUEUE_MAX:
+            raise RuntimeError("File d'attente audio pleine, réessaye dans un moment.")
+        waiting = sum(len(lane.get(req.user_id, ())) for lane in self._lanes)
+        if waiting >= AUDIO_QUEUE_MAX_PER_USER:
+            raise RuntimeError("Tu as déjà trop de lectures en attente, laisse la chance aux autres !")
+        self._lanes[req.lane].setdefault(req.user_id, deque()).append(req)
+        self._size += 1
+        self._wakeup.set()
+
+    def discard(self, req):
+        lane = self._lanes[req.lane]
+        items = lane.get(req.user_id)
+        if items and req in items:
+            items.remove(req)
+            if not items:
+                del lane[req.user_id]
+            self._size -= 1
+
+    @staticmethod
+    def _pop_from(lanes, clip_streak):
+        clips, tts = lanes
+        if clips and (not tts or clip_streak < AUDIO_CLIP_BURST):
+            lane, clip_streak = clips, clip_streak + 1
+        elif tts:
+            lane, clip_streak = tts, 0
         else:
-            logging.error(f"GPT error: {resp.status_code} {resp.text}")
-            return "Erreur : la réponse d'Azure OpenAI a échoué."
-    except Exception as ex:
-        logging.error(f"GPT network error: {ex}")
-        return "Erreur : impossible de contacter Azure OpenAI."
+            return None, clip_streak
+        user_id, items = next(iter(lane.items()))
+        req = items.popleft()
+        if items:
+            lane.move_to_end(user_id)  # au tour du prochain utilisateur
+        else:
+            del lane[user_id]
+        return req, clip_streak
+
+    async def get(self):
+        while not self._size:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        req, self._clip_streak = self._pop_from(self._lanes, self._clip_streak)
+        self._size -= 1
+        return req
+
+    def eta(self, req):
+        """(position, seconds) before req starts, by replaying the service order."""
+        wait = 0.0
+        if self.current is not None:
+            wait += max(0.0, self.current.estimate - (time.monotonic() - self.current_started))
+        position = 1
+        if self.prefetched is not None and self.prefetched is not self.current:
+            wait += self.prefetched.estimate
+            position += 1
+        lanes = tuple(OrderedDict((uid, deque(items)) for uid, items in lane.items()) for lane in self._lanes)
+        streak = self._clip_streak
+        while True:
+            nxt, streak = self._pop_from(lanes, streak)
+            if nxt is None or nxt is req:
+                return position, wait
+            wait += nxt.estimate
+            position += 1
+
+async def _notify_queue_eta(interaction, position, eta):
+    try:
+        await interaction.followup.send(
+            f"⏳ En file d'attente : position {position}, environ {eta:.0f}s avant ta lecture.", ephemeral=True)
+    except Exception:
+        pass
+
+async def play_audio(interaction, source, voice_channel, play_timeout=None, lane=None, estimate=None):
+    """Queue source (a file path, TTSStream or SpeechSequence) and wait for its playback.
 
-async def play_audio(interaction, file_path, voice_channel):
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File {file_path} not found.")
+    The time spent waiting in the queue (up to AUDIO_QUEUE_MAX_WAIT) is
+    counted separately from play_timeout, which only covers playback and
+    defaults to a margin over the known or estimated duration.
+    """
+    if isinstance(source, str) and not os.path.exists(source):
+        raise FileNotFoundError(f"File {source} not found.")
     guild = interaction.guild
     gid = guild.id if guild else 0
     # LOGIQUE DE BLOCAGE
     channel_id = voice_channel.id
     members_in_channel = [m.id for m in voice_channel.members if not m.bot]
-    blockers = is_vc_blocked_for_user(gid, channel_id, members_in_channel)
+    blockers = guild_state.blockers(gid, channel_id, members_in_channel)
     if blockers:
         blocked_by = ", ".join(f"<@{uid}>" for uid in blockers)
         raise RuntimeError(f"Accès refusé : bloqué par {blocked_by}. Attends 2h ou demande à retirer le blocage.")
-    queue = _voice_audio_queues[gid]
-    lock = _voice_locks[gid]
-    fut = asyncio.get_event_loop().create_future()
-    await queue.put((file_path, fut, voice_channel, interaction))
-    if not lock.locked():
-        asyncio.create_task(_run_audio_queue(guild, queue, lock))
-    await fut
-
-async def _run_audio_queue(guild, queue, lock):
-    async with lock:
-        while not queue.empty():
-            file_path, fut, voice_channel, interaction = await queue.get()
+    if lane is None:
+        in_library = isinstance(source, str) and \
+            os.path.dirname(os.path.abspath(source)) == os.path.abspath(AUDIO_DIR)
+        lane = AUDIO_LANE_CLIP if in_library else AUDIO_LANE_TTS
+    if estimate is None and isinstance(source, str):
+        estimate = audio_library.duration(source)
+    if estimate is None:
+        estimate = AUDIO_CLIP_ESTIMATE if lane == AUDIO_LANE_CLIP else AUDIO_TTS_ESTIMATE
+    if play_timeout is None:
+        play_timeout = max(AUDIO_MIN_PLAY_TIMEOUT, estimate * 1.5 + AUDIO_PLAY_MARGIN)
+    scheduler = _voice_schedulers.get(gid)
+    if scheduler is None:
+        scheduler = _voice_schedulers[gid] = GuildAudioScheduler()
+    req = AudioRequest(source, interaction.user.id, lane, estimate, voice_channel, interaction)
+    scheduler.put(req)
+    runner = _voice_queue_tasks.get(gid)
+    if runner is None or runner.done():
+        _voice_queue_tasks[gid] = asyncio.create_task(_run_audio_queue(guild, scheduler))
+    position, eta = scheduler.eta(req)
+    if eta >= AUDIO_ETA_NOTIFY:
+        asyncio.create_task(_notify_queue_eta(interaction, position, eta))
+    try:
+        await asyncio.wait_for(asyncio.shield(req.started), timeout=AUDIO_QUEUE_MAX_WAIT)
+    except asyncio.TimeoutError:
+        if not req.started.done():
+            scheduler.discard(req)
+            raise RuntimeError("Trop d'attente dans la file audio, ta lecture a été annulée.")
+    except BaseException:
+        if not req.started.done():
+            scheduler.discard(req)
+        raise
+    await asyncio.wait_for(asyncio.shield(req.done), timeout=play_timeout)
+
+def _make_audio_source(source):
+    # ffmpeg encode directement en Opus : discord.py n'a plus rien à ré-encoder
+    if isinstance(source, (TTSStream, SpeechSequence)):
+        with timed("jean_ffmpeg_spawn_seconds", input="pipe"):
+            return discord.FFmpegOpusAudio(source, pipe=True)
+    opus_path = audio_library.path_for(source)
+    if opus_path:
+        return OpusFileAudio(opus_path)
+    with timed("jean_ffmpeg_spawn_seconds", input="file"):
+        return discord.FFmpegOpusAudio(source)
+
+async def _ensure_voice(guild, voice_channel):
+    """Reuse the guild's voice connection, moving it only if the channel differs."""
+    vc = discord.utils.get(bot.voice_clients, guild=guild)
+    start = time.monotonic()
+    if not vc or not vc.is_connected():
+        vc = await voice_channel.connect()
+        action = "connect"
+        voice_stats["connects"] += 1
+    elif vc.channel != voice_channel:
+        await vc.move_to(voice_channel)
+        action = "move"
+        voice_stats["moves"] += 1
+    else:
+        action = "reuse"
+        voice_stats["reuses"] += 1
+    elapsed = time.monotonic() - start
+    voice_stats["connect_seconds"] += elapsed
+    observe("jean_voice_connect_seconds", elapsed, action=action)
+    return vc, elapsed
+
+async def _disconnect_idle(guild):
+    vc = discord.utils.get(bot.voice_clients, guild=guild)
+    if vc and vc.is_connected() and not vc.is_playing():
+        await vc.disconnect()
+        voice_stats["idle_disconnects"] += 1
+        logging.info("[%s] Voice idle for %ss, disconnected.", guild.id if guild else 0, VOICE_IDLE_TIMEOUT)
+
+def _resolve_future(fut, error=None):
+    if fut.done():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(None)
+
+class GuildAudioStream(discord.AudioSource):
+    """Long-lived per-guild source that plays queued items back to back.
+
+    The voice client keeps playing this one source; the runner hands it the
+    next item (already opened, ffmpeg already started) while the current one
+    plays, so there is no gap and no new player between items. Every item
+    is Opus, so frames are passed through untouched (no crossfade).
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._items = deque()  # (source, started, done)
+        self._current = None
+        self._lock = threading.Lock()
+        self._idle_frames = 0
+        self.finished = False
+
+    def add(self, source, started, done):
+        """Queue an opened source; False if the player already stopped."""
+        with self._lock:
+            if self.finished:
+                return False
+            self._items.append((source, started, done))
+            return True
+
+    def read(self):
+        while True:
+            if self._current is None:
+                with self._lock:
+                    if not self._items:
+                        # un peu de silence laisse au runner le temps d'enchaîner
+                        self._idle_frames += 1
+                        if self._idle_frames > AUDIO_STREAM_LINGER_FRAMES:
+                            self.finished = True
+                            return b""
+                        return OPUS_SILENCE
+                    self._current = self._items.popleft()
+                self._idle_frames = 0
+                self._loop.call_soon_threadsafe(_resolve_future, self._current[1])
+            source, error = self._current[0], None
             try:
-                vc = discord.utils.get(bot.voice_clients, guild=guild)
-                if not vc or not vc.is_connected():
-                    vc = await voice_channel.connect()
-                elif vc.channel != voice_channel:
-                    await vc.move_to(voice_channel)
-                vc.play(discord.FFmpegPCMAudio(file_path))
-                while vc.is_playing():
-                    await asyncio.sleep(1)
-                await vc.disconnect()
-                fut.set_result(None)
-            except Exception as e:
-                fut.set_exception(e)
-            finally:
+                data = source.read()
+            except Exception as ex:
+                data, error = b"", ex
+            if data:
+                return data
+            self._end_current(error)
+
+    def _end_current(self, error=None):
+        source, started, done = self._current
+        self._current = None
+        try:
+            source.cleanup()
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(_resolve_future, done, error)
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        # lecteur arrêté (stop, déconnexion, erreur) : ce qui reste est perdu
+        with self._lock:
+            self.finished = True
+            items, self._items = list(self._items), deque()
+        if self._current is not None:
+            self._end_current(RuntimeError("Lecture interrompue."))
+        for source, started, done in items:
+            try:
+                source.cleanup()
+            except Exception:
+                pass
+            error = RuntimeError("Lecture interrompue.")
+            self._loop.call_soon_threadsafe(_resolve_future, started, error)
+            self._loop.call_soon_threadsafe(_resolve_future, done, error)
+
+async def _track_request(gid, scheduler, req, started, done, connect_time):
+    """Follow one item through the guild stream and settle the caller's futures."""
+    lane = "clip" if req.lane == AUDIO_LANE_CLIP else "tts"
+    try:
+        await started
+        start = time.monotonic()
+        queue_wait = start - req.enqueued_at
+        voice_stats["queue_wait_seconds"] += queue_wait
+        observe("jean_audio_queue_wait_seconds", queue_wait, lane=lane)
+        scheduler.current, scheduler.current_started = req, start
+        if scheduler.prefetched is req:
+            scheduler.prefetched = None
+        _resolve_future(req.started)
+        await done
+        play_time = time.monotonic() - start
+        voice_stats["played"] += 1
+        voice_stats["play_seconds"] += play_time
+        observe("jean_audio_playback_seconds", play_time, lane=lane)
+        logging.info("[%s] Queue wait %.2fs, voice connect %.2fs, playback %.2fs.",
+                     gid, queue_wait, connect_time, play_time)
+        _resolve_future(req.done)
+    except Exception as e:
+        count_error("voice", e)
+        _resolve_future(req.started)
+        _resolve_future(req.done, e)
+    finally:
+        if scheduler.current is req:
+            scheduler.current = None
+        if scheduler.prefetched is req:
+            scheduler.prefetched = None
+        if isinstance(req.source, (TTSStream, SpeechSequence)):
+            req.source.close()
+
+def _on_player_end(gid, loop, stopped, error):
+    # appelé dans le thread du lecteur, une fois qu'il a rendu la main
+    if error:
+        logging.warning("[%s] Voice player stopped: %r", gid, error)
+    loop.call_soon_threadsafe(stopped.set)
+
+async def _run_audio_queue(guild, scheduler):
+    gid = guild.id if guild else 0
+    # tâche longue : elle ne garde pas la commande qui l'a lancée dans ses logs
+    log_context.set({"guild": gid})
+    loop = asyncio.get_running_loop()
+    stream = None
+    player_stopped = None  # posé par le after= du lecteur qui joue stream
+    previous_done = None
+    while True:
+        next_req = asyncio.ensure_future(scheduler.get())
+        if previous_done is not None and not previous_done.done():
+            # l'élément remis au flux joue encore : le délai d'inactivité part de sa fin
+            await asyncio.wait({next_req, previous_done}, return_when=asyncio.FIRST_COMPLETED)
+        try:
+            req = await asyncio.wait_for(next_req, timeout=VOICE_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            try:
+                await _disconnect_idle(guild)
+            except Exception as ex:
+                logging.warning("[%s] Voice disconnect failed: %s", gid, ex)
+            if not len(scheduler):
+                break
+            continue
+        vc = discord.utils.get(bot.voice_clients, guild=guild)
+        if previous_done is not None and vc and vc.channel != req.voice_channel:
+            # on termine ce qui joue dans l'ancien salon avant de bouger
+            await asyncio.wait({previous_done})
+        started, done = loop.create_future(), loop.create_future()
+        try:
+            vc, connect_time = await _ensure_voice(guild, req.voice_channel)
+            source = _make_audio_source(req.source)
+        except Exception as e:
+            count_error("voice", e)
+            _resolve_future(req.started)
+            _resolve_future(req.done, e)
+            if isinstance(req.source, (TTSStream, SpeechSequence)):
+                req.source.close()
+            continue
+        scheduler.prefetched = req
+        asyncio.create_task(_track_request(gid, scheduler, req, started, done, connect_time))
+        new_stream = None
+        try:
+            if stream is not None and vc.is_playing() and stream.add(source, started, done):
+                voice_stats["gapless"] += 1
+            else:
+                if player_stopped is not None and vc.is_playing():
+                    # le flux a fini mais le thread du lecteur n'est pas encore sorti :
+                    # vc.play() lèverait « Already playing audio »
+                    await asyncio.wait_for(player_stopped.wait(), timeout=AUDIO_PLAYER_STOP_WAIT)
+                new_stream = GuildAudioStream(loop)
+                new_stream.add(source, started, done)
+                stopped = asyncio.Event()
+                vc.play(new_stream, after=functools.partial(_on_player_end, gid, loop, stopped))
+                stream, player_stopped = new_stream, stopped
+                voice_stats["player_starts"] += 1
+        except Exception as e:
+            # ex. lecteur toujours occupé après AUDIO_PLAYER_STOP_WAIT
+            count_error("voice", e)
+            _resolve_future(started, e)
+            _resolve_future(done, e)
+            if new_stream is not None:
+                new_stream.cleanup()  # jamais joué : libère la source qu'il tient
+            else:
                 try:
-                    if file_path.startswith(tempfile.gettempdir()) and os.path.exists(file_path):
-                        os.remove(file_path)
-                except Exception as ex:
-                    logging.warning(f"Erreur suppression fichier temp: {ex}")
+                    source.cleanup()
+                except Exception:
+                    pass
+            continue
+        # un seul élément d'avance : on attend que le précédent finisse avant d'en préparer un autre
+        if previous_done is not None:
+            await asyncio.wait({previous_done})
+        previous_done = done
+
+# ----- Fin file audio -----
+
+# ----- Démarrage -----
+COMMAND_TREE_HASH_FILE = config.get("command_tree_hash_file", ".command_tree.sha256")
+FORCE_COMMAND_SYNC = "--sync-commands" in sys.argv
+_startup_phases = {}  # phase: secondes
+_ready_at = None
+_first_command_at = None
+
+async def run_startup_phase(name, awaitable):
+    """Await one startup step, recording its duration; a failure is logged, not fatal."""
+    start = time.monotonic()
+    try:
+        return await awaitable
+    except Exception as ex:
+        logging.warning(f"Startup phase {name} failed: {ex}")
+        count_error("startup", ex)
+    finally:
+        _startup_phases[name] = time.monotonic() - start
+        observe("jean_startup_seconds", _startup_phases[name], phase=name)
+
+def command_tree_hash():
+    """sha256 of the application commands as Discord would receive them."""
+    payload = []
+    for cmd in sorted(bot.tree.get_commands(), key=lambda c: c.name):
+        try:
+            payload.append(cmd.to_dict(bot.tree))
+        except TypeError:  # discord.py < 2.4
+            payload.append(cmd.to_dict())
+    raw = json.dumps([bot.application_id, payload], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+async def sync_command_tree():
+    """Push the command tree to Discord only if it changed since the last successful sync."""
+    digest = command_tree_hash()
+    try:
+        with open(COMMAND_TREE_HASH_FILE, "r") as f:
+            synced_digest = f.read().strip()
+    except OSError:
+        synced_digest = None
+    if digest == synced_digest and not FORCE_COMMAND_SYNC:
+        logging.info("Slash commands unchanged, sync skipped.")
+        return
+    synced = await bot.tree.sync()
+    with open(COMMAND_TREE_HASH_FILE, "w") as f:
+        f.write(digest)
+    logging.info(f"Slash commands synced: {len(synced)} cmds")
+
+async def warmup():
+    """Heavy startup work, run in parallel off the login path; each phase is timed.
 
-async def _delayed_reset_gpt(gid):
-    await asyncio.sleep(24 * 3600)
-    _guild_gpt_prompt[gid] = DEFAULT_GPT_PROMPT
-    _guild_gpt_prompt_reset_task[gid] = None
+    Each background loop starts as soon as its own data is loaded: a slow
+    first audio build or command sync does not hold back the Reddit fetch.
+    """
+    start = time.monotonic()
 
-async def _delayed_reset_sayvc(gid):
-    await asyncio.sleep(24 * 3600)
-    _guild_sayvc_instructions[gid] = DEFAULT_SAYVC_INSTRUCTIONS
-    _guild_sayvc_reset_task[gid] = None
+    async def corpus_then_loops():
+        await run_startup_phase("reddit_corpus", reload_joke_snapshot())
+        _start_loops(reddit_refresh_task, joke_pool_task)
 
-def _cancel_task(task):
-    if task and not task.done():
-        task.cancel()
+    async def audio_then_rescan():
+        await run_startup_phase("audio_library", build_pool.run(audio_library.build))
+        _start_loops(audio_library_task)
+
+    phases = [
+        corpus_then_loops(),
+        audio_then_rescan(),
+        run_startup_phase("tts_cache", disk_pool.run(tts_cache.load)),
+    ]
+    if SHARD_IDS is None or 0 in SHARD_IDS:  # l'arbre est global : un seul processus le synchronise
+        phases.append(run_startup_phase("command_sync", sync_command_tree()))
+    await asyncio.gather(*phases)
+    _startup_phases["warmup"] = time.monotonic() - start
+    logging.info("Startup phases: " + ", ".join(f"{name} {secs:.2f}s" for name, secs in _startup_phases.items()))
+
+def _start_loops(*loops):
+    for loop in loops:
+        if not loop.is_running():
+            loop.start()
+
+def note_first_command():
+    global _first_command_at
+    _first_command_at = time.monotonic()
+    _startup_phases["first_command"] = _first_command_at - PROCESS_START
+    observe("jean_startup_seconds", _startup_phases["first_command"], phase="first_command")
+    logging.info(f"First command {_startup_phases['first_command']:.2f}s after process start.")
 
 @bot.event
 async def on_ready():
-    logging.info(f"Bot logged in as {bot.user}!")
+    global _ready_at
+    if _ready_at is not None:
+        # reconnexion complète au gateway : tout est déjà prêt
+        logging.info(f"Gateway session re-established as {bot.user}, startup work skipped.")
+        return
+    _ready_at = time.monotonic()
+    _startup_phases["ready"] = _ready_at - PROCESS_START
+    observe("jean_startup_seconds", _startup_phases["ready"], phase="ready")
+    logging.info(f"Bot logged in as {bot.user}! Ready {_startup_phases['ready']:.2f}s after process start.")
     print(f"Logged in as {bot.user}!")
+# ----- Fin démarrage -----
+
+async def reload_joke_snapshot():
+    """Load the on-disk corpus if the file changed since we last read it."""
+    global _corpus_saved_at, _corpus_mtime
     try:
-        synced = await bot.tree.sync()
-        print(f"Slash commands synced: {len(synced)} cmds")
-    except Exception as e:
-        print(e)
-    await bot.change_presence(activity=discord.Game(name="Tape /help"))
-    preload_jokes_task.start()
+        mtime = os.path.getmtime(REDDIT_CORPUS_FILE)
+    except OSError:
+        return
+    if mtime == _corpus_mtime:
+        return
+    jokes, saved_at, newest_post = await reddit_pool.run(load_joke_snapshot)
+    _corpus_mtime = mtime
+    if jokes:
+        set_reddit_jokes(jokes)
+        _corpus_saved_at = saved_at
+        reddit_newest_post.update(newest_post)
+        logging.info(f"Loaded {sum(len(x) for x in jokes.values())} jokes from {REDDIT_CORPUS_FILE}.")
+
+@tasks.loop(minutes=15)
+async def reddit_refresh_task():
+    """Incremental refresh once the corpus is older than reddit_refresh_hours.
+
+    Only one process (the holder of the corpus lock) talks to Reddit; the
+    others follow the snapshot it writes.
+    """
+    global _corpus_saved_at, _corpus_mtime
+    while not reddit_leader.try_acquire():
+        await reload_joke_snapshot()
+        if reddit_jokes_by_sub:
+            return
+        await asyncio.sleep(REDDIT_FOLLOWER_POLL)
+    await reload_joke_snapshot()  # reprise du corpus de l'ancien leader
+    if reddit_jokes_by_sub and time.time() - _corpus_saved_at < REDDIT_REFRESH_INTERVAL:
+        return
+    jokes = await load_reddit_jokes(previous=reddit_jokes_by_sub)
+    if not jokes:
+        return
+    set_reddit_jokes(jokes)
+    _corpus_saved_at = time.time()
+    await reddit_pool.run(save_joke_snapshot, jokes, _corpus_saved_at, dict(reddit_newest_post))
+    try:
+        _corpus_mtime = os.path.getmtime(REDDIT_CORPUS_FILE)
+    except OSError:
+        pass
+
+@tasks.loop(seconds=AUDIO_RESCAN_INTERVAL)
+async def audio_library_task():
+    # incrémental : seuls les sons ajoutés ou modifiés repassent par ffmpeg
+    try:
+        await build_pool.run(audio_library.build)
+    except Exception as ex:
+        logging.warning(f"Audio library scan failed: {ex}")
+
+# ----- Réserve de blagues pré-synthétisées -----
+def _build_joke_weights(jokes):
+    """Cumulative weights per subreddit, favouring the top of the ranking."""
+    return {
+        sub: list(itertools.accumulate(math.exp(-JOKE_RANK_BIAS * i) for i in range(len(posts))))
+        for sub, posts in jokes.items()
+    }
+
+def set_reddit_jokes(jokes):
+    global reddit_jokes_by_sub, _joke_cum_weights
+    # pas d'await entre les deux : /joke voit toujours un corpus et ses poids cohérents
+    reddit_jokes_by_sub, _joke_cum_weights = jokes, _build_joke_weights(jokes)
+    _wake_joke_pool()
+
+def pick_reddit_joke(sub, recent=()):
+    """Weighted O(log n) pick; retries a few times to skip jokes in recent."""
+    posts = reddit_jokes_by_sub[sub]
+    cum = _joke_cum_weights[sub]
+    for _ in range(JOKE_RECENT_RETRIES):
+        idx = min(bisect.bisect_right(cum, random.random() * cum[-1]), len(posts) - 1)
+        joke_text = posts[idx].text
+        if joke_text not in recent:
+            break
+    return joke_text
+
+def take_pooled_joke(sub, recent=()):
+    """Pop a joke whose audio is already in the TTS cache, or None."""
+    pool = _joke_pool.get(sub)
+    _wake_joke_pool()
+    if not pool:
+        return None
+    for joke_text in pool:
+        if joke_text not in recent:
+            pool.remove(joke_text)
+            return joke_text
+    return None
+
+def remember_joke(gid, joke_text):
+    if not JOKE_RECENT_SIZE:
+        return
+    recent = _recent_jokes.get(gid)
+    if recent is None:
+        recent = _recent_jokes[gid] = OrderedDict()
+    recent[joke_text] = None
+    recent.move_to_end(joke_text)
+    while len(recent) > JOKE_RECENT_SIZE:
+        recent.popitem(last=False)
+
+def _wake_joke_pool():
+    if _joke_pool_wakeup is not None:
+        _joke_pool_wakeup.set()
+
+async def _refill_joke_pool():
+    for sub in list(reddit_jokes_by_sub.keys()):
+        pool = _joke_pool[sub]
+        attempts = 0
+        while len(pool) < JOKE_POOL_SIZE and attempts < JOKE_POOL_SIZE * 2:
+            attempts += 1
+            joke_text = pick_reddit_joke(sub)
+            if joke_text in pool:
+                continue
+            try:
+                ok = await asyncio.wait_for(
+                    warm_tts(joke_text, JOKE_VOICE, JOKE_TTS_INSTRUCTIONS),
+                    timeout=20
+                )
+            except Exception as ex:
+                logging.warning(f"Joke pool synthesis failed for r/{sub}: {ex}")
+                ok = False
+            if not ok:
+                return  # TTS en panne, on réessaiera au prochain réveil
+            pool.append(joke_text)
 
 @tasks.loop(count=1)
-async def preload_jokes_task():
-    global reddit_jokes_by_sub
-    await asyncio.sleep(2)
-    reddit_jokes_by_sub = await load_reddit_jokes()
+async def joke_pool_task():
+    global _joke_pool_wakeup
+    _joke_pool_wakeup = asyncio.Event()
+    while True:
+        _joke_pool_wakeup.clear()
+        if reddit_jokes_by_sub:
+            await _refill_joke_pool()
+        try:
+            await asyncio.wait_for(_joke_pool_wakeup.wait(), timeout=JOKE_POOL_REFILL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+# ----- Fin réserve de blagues -----
 
 @bot.tree.command(name="ping", description="Renvoie Pong !")
 @log_command_decorator
@@ -330,8 +3151,7 @@ async def bloque(interaction: discord.Interaction):
         return
     guild = interaction.guild
     channel = user.voice.channel
-    key = (guild.id, channel.id)
-    _vc_blocks[key][user.id] = time.time() + 2 * 3600
+    await guild_state.block(guild.id, channel.id, user.id, VC_BLOCK_DURATION)
     await interaction.response.send_message(
         f"🔒 Le bot ne peux rejoindre **{channel.name}** pour toi pendant 2h. Refais `/bloque` pour prolonger.",
         ephemeral=True)
@@ -346,9 +3166,7 @@ async def debloque(interaction: discord.Interaction):
         return
     guild = interaction.guild
     channel = user.voice.channel
-    key = (guild.id, channel.id)
-    if user.id in _vc_blocks[key]:
-        del _vc_blocks[key][user.id]
+    if await guild_state.unblock(guild.id, channel.id, user.id):
         await interaction.response.send_message(
             f"✅ Le blocage dans **{channel.name}** est retiré. Le bot peut à nouveau venir.", ephemeral=True)
     else:
@@ -360,14 +3178,17 @@ async def debloque(interaction: discord.Interaction):
 @log_command_decorator
 async def jokeqc(interaction: discord.Interaction, voice_channel: discord.VoiceChannel = None):
     await interaction.response.defer(thinking=True, ephemeral=True)
-    file = random.choice(audio_files)
+    file = audio_library.pick()
+    if not file:
+        await interaction.followup.send("Aucun son disponible pour le moment.", ephemeral=True)
+        return
     vc_channel = get_voice_channel(interaction, voice_channel)
     if not vc_channel:
         await interaction.followup.send(
             "Vous devez être dans un salon vocal, ou préciser un vocal !", ephemeral=True)
         return
     try:
-        await asyncio.wait_for(play_audio(interaction, os.path.join(AUDIO_DIR, file), vc_channel), timeout=30)
+        await play_audio(interaction, os.path.join(AUDIO_DIR, file), vc_channel)
     except RuntimeError as exc:
         await interaction.followup.send(str(exc), ephemeral=True)
     except Exception as exc:
@@ -386,38 +3207,24 @@ async def joke(interaction: discord.Interaction, voice_channel: discord.VoiceCha
     if not reddit_jokes_by_sub:
         await interaction.followup.send("Aucune blague pour le moment, réessaye plus tard.", ephemeral=True)
         return
-    sub = random.choice(list(reddit_jokes_by_sub.keys()))
-    posts = reddit_jokes_by_sub[sub]
-    bias = 0.02
-    weights = [math.exp(-bias * i) for i in range(len(posts))]
-    idx = random.choices(range(len(posts)), weights=[w/sum(weights) for w in weights], k=1)[0]
-    post = posts[idx]["data"]
-    joke_text = f"{post['title']}. {post['selftext']}".strip()
     vc_channel = get_voice_channel(interaction, voice_channel)
     if not vc_channel:
         await interaction.followup.send(
             "Vous devez être dans un salon vocal, ou préciser un vocal !", ephemeral=True)
         return
-    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp:
-        filename = tmp.name
-    loop = asyncio.get_running_loop()
+    gid = interaction.guild.id if interaction.guild else None
+    recent = _recent_jokes.get(gid, ())
+    sub = random.choice(list(reddit_jokes_by_sub.keys()))
+    joke_text = take_pooled_joke(sub, recent) or pick_reddit_joke(sub, recent)
+    remember_joke(gid, joke_text)
     try:
-        success = await asyncio.wait_for(
-            loop.run_in_executor(None, run_tts, joke_text, filename, "ash",
-                                 "Read this joke with a comic tone, as if you are a stand-up comedian."),
-            timeout=20
-        )
-        if not success: raise Exception("Erreur lors de la génération de la synthèse vocale.")
-        await asyncio.wait_for(play_audio(interaction, filename, vc_channel), timeout=30)
+        await play_tts(interaction, joke_text, JOKE_VOICE, JOKE_TTS_INSTRUCTIONS, vc_channel)
     except RuntimeError as exc:
         await interaction.followup.send(str(exc), ephemeral=True)
     except Exception as exc:
         await interaction.followup.send(f"Erreur : {exc}", ephemeral=True)
     else:
         await interaction.followup.send("Blague lue dans le salon vocal.", ephemeral=True)
-    finally:
-        try: os.remove(filename)
-        except: pass
 
 @bot.tree.command(name="leave", description="Quitte le vocal")
 @log_command_decorator
@@ -446,7 +3253,7 @@ async def penis(interaction: discord.Interaction, voice_channel: discord.VoiceCh
         )
         return
     try:
-        await asyncio.wait_for(play_audio(interaction, file, vc_channel), timeout=30)
+        await play_audio(interaction, file, vc_channel)
     except RuntimeError as exc:
         await interaction.followup.send(str(exc), ephemeral=True)
     except Exception as exc:
@@ -466,25 +3273,14 @@ async def say_with_tts(interaction, message, voice, instructions, voice_channel)
     if not voice_channel:
         await interaction.followup.send("Vous devez être dans un salon vocal ou en préciser un.", ephemeral=True)
         return
-    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp:
-        filename = tmp.name
-    loop = asyncio.get_running_loop()
     try:
-        success = await asyncio.wait_for(
-            loop.run_in_executor(None, run_tts, message, filename, voice, instructions),
-            timeout=20
-        )
-        if not success: raise Exception("Erreur lors de la génération de la synthèse vocale.")
-        await asyncio.wait_for(play_audio(interaction, filename, voice_channel), timeout=30)
+        await play_tts(interaction, message, voice, instructions, voice_channel)
     except RuntimeError as exc:
         await interaction.followup.send(str(exc), ephemeral=True)
     except Exception as exc:
         await interaction.followup.send(f"Erreur : {exc}", ephemeral=True)
     else:
         await interaction.followup.send("Lecture audio lancée dans le salon vocal.", ephemeral=True)
-    finally:
-        try: os.remove(filename)
-        except: pass
 
 @bot.tree.command(
     name="say-vc",
@@ -507,9 +3303,7 @@ async def say_vc(
     gid = interaction.guild.id if interaction.guild else None
     await interaction.response.defer(thinking=True, ephemeral=True)
     if instructions is not None and sauvegarder_instructions:
-        _guild_sayvc_instructions[gid] = instructions
-        _cancel_task(_guild_sayvc_reset_task.get(gid))
-        _guild_sayvc_reset_task[gid] = asyncio.create_task(_delayed_reset_sayvc(gid))
+        await guild_state.set(gid, "sayvc_instructions", instructions, ttl=GUILD_SETTING_TTL)
         info = "(Style vocal sauvegardé 24h.)"
     else:
         info = ""
@@ -517,11 +3311,22 @@ async def say_vc(
     if not vc_channel:
         await interaction.followup.send("Vous devez être dans un salon vocal ou en préciser un.", ephemeral=True)
         return
-    current_instructions = instructions if instructions is not None else _guild_sayvc_instructions[gid]
+    current_instructions = instructions if instructions is not None else guild_state.get(gid, "sayvc_instructions", DEFAULT_SAYVC_INSTRUCTIONS)
     await say_with_tts(interaction, message, "ash", current_instructions, vc_channel)
     if info:
         await interaction.followup.send(info, ephemeral=True)
 
+def _gpt_embed(query, reply):
+    embed = discord.Embed(title="Réponse GPT-4o", color=0x00bcff, description=f"**Q :** {query}")
+    maxlen = 1024
+    chunks = [reply[i:i+maxlen] for i in range(0, len(reply), maxlen)]
+    for idx, chunk in enumerate(chunks[:25]):
+        name = "Réponse" if idx == 0 else f"(suite {idx})"
+        embed.add_field(name=name, value=chunk, inline=False)
+    if len(chunks) > 25:
+        embed.add_field(name="Info", value="(réponse tronquée, trop longue !)", inline=False)
+    return embed
+
 @bot.tree.command(
     name="gpt",
     description="Pose une question à GPT-4o puis lit la réponse"
@@ -542,58 +3347,43 @@ async def gpt(
 ):
     gid = interaction.guild.id if interaction.guild else None
     if prompt is not None and sauvegarder_prompt:
-        _guild_gpt_prompt[gid] = prompt
-        _cancel_task(_guild_gpt_prompt_reset_task.get(gid))
-        _guild_gpt_prompt_reset_task[gid] = asyncio.create_task(_delayed_reset_gpt(gid))
         info = "(Prompt GPT sauvegardé 24h.)"
     else:
         info = ""
-    system_prompt = prompt if prompt is not None else _guild_gpt_prompt[gid]
+    system_prompt = prompt if prompt is not None else guild_state.get(gid, "gpt_prompt", DEFAULT_GPT_PROMPT)
     await interaction.response.defer(thinking=True)
-    loop = asyncio.get_running_loop()
+    if info:
+        await guild_state.set(gid, "gpt_prompt", prompt, ttl=GUILD_SETTING_TTL)
+    if lecture_vocale and (interaction.user.voice and interaction.user.voice.channel):
+        vc_channel = interaction.user.voice.channel
+    else:
+        vc_channel = None
+    instructions = "Lis la réponse d'une voix naturelle avec un ton informatif."
     try:
-        reply = await asyncio.wait_for(
-            loop.run_in_executor(None, run_gpt, query, system_prompt),
-            timeout=22
+        reply, speech = await stream_gpt_reply(
+            interaction, query, system_prompt,
+            lambda text: _gpt_embed(query, text),
+            vc_channel if TTS_CHUNKED_REPLIES else None, instructions,
+            cache=True
         )
     except Exception as ex:
         await interaction.followup.send(f"Erreur GPT : {ex}", ephemeral=True)
         return
-    embed = discord.Embed(title="Réponse GPT-4o", color=0x00bcff, description=f"**Q :** {query}")
-    maxlen = 1024
-    chunks = [reply[i:i+maxlen] for i in range(0, len(reply), maxlen)]
-    for idx, chunk in enumerate(chunks[:25]):
-        name = "Réponse" if idx == 0 else f"(suite {idx})"
-        embed.add_field(name=name, value=chunk, inline=False)
-    if len(chunks) > 25:
-        embed.add_field(name="Info", value="(réponse tronquée, trop longue !)", inline=False)
-    await interaction.followup.send(embed=embed)
     if info:
         await interaction.followup.send(info)
-    if lecture_vocale and (interaction.user.voice and interaction.user.voice.channel):
-        vc_channel = interaction.user.voice.channel
-    else:
-        vc_channel = None
-    if lecture_vocale and vc_channel and reply:
-        short_reply = reply[:500]
-        instructions = "Lis la réponse d'une voix naturelle avec un ton informatif."
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp:
-            filename = tmp.name
-        try:
-            success = await asyncio.wait_for(
-                loop.run_in_executor(None, run_tts, short_reply, filename, "ash", instructions),
-                timeout=20
-            )
-            if success:
-                await asyncio.wait_for(play_audio(interaction, filename, vc_channel), timeout=30)
+    if vc_channel and reply:
+        try:
+            if speech:
+                await speech
+            else:
+                await play_tts(interaction, reply[:500], "ash", instructions, vc_channel)
         except RuntimeError as exc:
             await interaction.followup.send(str(exc), ephemeral=True)
         except Exception:
             pass
-        finally:
-            try: os.remove(filename)
-            except: pass
         await interaction.followup.send("Réponse lue dans le salon vocal.")
+    elif speech:
+        speech.cancel()
 
 @bot.tree.command(
     name="roast",
@@ -632,42 +3422,32 @@ async def roast(
         "Humour direct, accent québécois, max 4 phrases, pas d'intro."
     )
     titre = f"Roast de {username} (niv. {intensite})"
+    couleur = 0xff8800 if intensite < 4 else 0xff0000
     await interaction.response.defer(thinking=True)
-    loop = asyncio.get_running_loop()
+    vc_channel = get_voice_channel(interaction, voice_channel)
+    instructions = "Lis ce roast façon humoriste québécois, franc-parler."
     try:
-        texte = await asyncio.wait_for(
-            loop.run_in_executor(
-                None, run_gpt, prompt_gpt,
-                "Stand-up québécois, franc-parler et punch."
-            ),
-            timeout=18
+        texte, speech = await stream_gpt_reply(
+            interaction, prompt_gpt,
+            "Stand-up québécois, franc-parler et punch.",
+            lambda text: discord.Embed(title=titre, description=text, color=couleur),
+            vc_channel if TTS_CHUNKED_REPLIES else None, instructions
         )
     except Exception as ex:
         await interaction.followup.send(
             f"Erreur génération roast: {ex}", ephemeral=True
         )
         return
-    embed = discord.Embed(title=titre, description=texte, color=0xff8800 if intensite < 4 else 0xff0000)
-    await interaction.followup.send(embed=embed)
-    vc_channel = get_voice_channel(interaction, voice_channel)
     if vc_channel:
-        instructions = "Lis ce roast façon humoriste québécois, franc-parler."
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp:
-            filename = tmp.name
         try:
-            success = await asyncio.wait_for(
-                loop.run_in_executor(None, run_tts, texte, filename, "ash", instructions),
-                timeout=20
-            )
-            if success:
-                await asyncio.wait_for(play_audio(interaction, filename, vc_channel), timeout=30)
+            if speech:
+                await speech
+            else:
+                await play_tts(interaction, texte, "ash", instructions, vc_channel)
         except RuntimeError as exc:
             await interaction.followup.send(str(exc), ephemeral=True)
         except Exception as e:
             await interaction.followup.send(f"Erreur audio : {e}", ephemeral=True)
-        finally:
-            try: os.remove(filename)
-            except: pass
         await interaction.followup.send("Roast balancé au vocal!", ephemeral=True)
     else:
         await interaction.followup.send("(Rejoins ou précise un salon vocal !)", ephemeral=True)
@@ -697,37 +3477,30 @@ async def compliment(
     )
     titre = f"Compliment pour {username}"
     await interaction.response.defer(thinking=True)
-    loop = asyncio.get_running_loop()
+    vc_channel = get_voice_channel(interaction, voice_channel)
+    instructions = "Lis ce compliment façon humoriste québécois, émerveillé."
     try:
-        texte = await asyncio.wait_for(
-            loop.run_in_executor(None, run_gpt, prompt_gpt,
-            "Compliments québécois."
-        ),timeout=18)
+        texte, speech = await stream_gpt_reply(
+            interaction, prompt_gpt,
+            "Compliments québécois.",
+            lambda text: discord.Embed(title=titre, description=text, color=0x41d98e),
+            vc_channel if TTS_CHUNKED_REPLIES else None, instructions
+        )
     except Exception as ex:
         await interaction.followup.send(
             f"Erreur génération compliment: {ex}", ephemeral=True
         )
         return
-    embed = discord.Embed(title=titre, description=texte, color=0x41d98e)
-    await interaction.followup.send(embed=embed)
-    vc_channel = get_voice_channel(interaction, voice_channel)
     if vc_channel:
-        instructions = "Lis ce compliment façon humoriste québécois, émerveillé."
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp: filename = tmp.name
         try:
-            success = await asyncio.wait_for(
-                loop.run_in_executor(None, run_tts, texte, filename, "ash", instructions),
-                timeout=20
-            )
-            if success:
-                await asyncio.wait_for(play_audio(interaction, filename, vc_channel), timeout=30)
+            if speech:
+                await speech
+            else:
+                await play_tts(interaction, texte, "ash", instructions, vc_channel)
         except RuntimeError as exc:
             await interaction.followup.send(str(exc), ephemeral=True)
         except Exception as e:
             await interaction.followup.send(f"Erreur audio : {e}", ephemeral=True)
-        finally:
-            try: os.remove(filename)
-            except: pass
         await interaction.followup.send("Compliment lancé au vocal!", ephemeral=True)
     else:
         await interaction.followup.send("(Rejoins ou précise un salon vocal !)", ephemeral=True)
@@ -812,24 +3585,20 @@ async def help(interaction: discord.Interaction):
 async def reset_prompts(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True, ephemeral=True)
     gid = interaction.guild.id if interaction.guild else None
-    _guild_gpt_prompt[gid] = DEFAULT_GPT_PROMPT
-    _guild_sayvc_instructions[gid] = DEFAULT_SAYVC_INSTRUCTIONS
-    _cancel_task(_guild_gpt_prompt_reset_task.get(gid))
-    _guild_gpt_prompt_reset_task[gid] = None
-    _cancel_task(_guild_sayvc_reset_task.get(gid))
-    _guild_sayvc_reset_task[gid] = None
+    await guild_state.delete(gid, "gpt_prompt")
+    await guild_state.delete(gid, "sayvc_instructions")
     await interaction.followup.send(
         f"Prompts/instructions réinitialisés sur ce serveur.",
         ephemeral=True
     )
-    logging.info(f"[{gid}] All prompts/instructions reset by {interaction.user}.")
+    logging.info("[%s] All prompts/instructions reset by %s.", gid, interaction.user)
 
 # ======== Commande historique ========
 @bot.tree.command(name="history", description="Afficher tes 15 dernières commandes du bot (éphémère)")
 @log_command_decorator
 async def history(interaction: discord.Interaction):
     await interaction.response.defer(thinking=True, ephemeral=True)
-    items = get_recent_history(15)
+    items = await disk_pool.run(get_recent_history, 15)
     if not items:
         await interaction.followup.send("Aucun historique de commandes trouvé.", ephemeral=True)
         return
@@ -848,13 +3617,75 @@ async def history(interaction: discord.Interaction):
     await interaction.followup.send(embed=embed, ephemeral=True)
 # ======== Fin historique =============
 
+def run_shard_launcher(processes, shard_count):
+    """Run one bot process per shard group and restart the ones that crash.
+
+    Shards are dealt round-robin so each process gets a similar guild count;
+    children get --shard-ids/--shard-count/--process-index on their command line.
+    """
+    processes = max(1, min(processes, shard_count))
+    groups = [list(range(i, shard_count, processes)) for i in range(processes)]
+    children, started, restart_at, delays = {}, {}, {}, {}
+
+    def spawn(index):
+        args = [sys.executable, os.path.abspath(__file__),
+                "--shard-count", str(shard_count),
+                "--shard-ids", ",".join(map(str, groups[index])),
+                "--process-index", str(index),
+                "--processes", str(processes)]
+        children[index] = subprocess.Popen(args)
+        started[index] = time.monotonic()
+        logging.info(f"Shard process {index} started (pid {children[index].pid}, shards {groups[index]}).")
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logging.info(f"Launching {shard_count} shards in {processes} processes.")
+    for index in range(processes):
+        spawn(index)
+    try:
+        while children or restart_at:
+            time.sleep(1)
+            now = time.monotonic()
+            for index, proc in list(children.items()):
+                code = proc.poll()
+                if code is None:
+                    continue
+                del children[index]
+                if code == 0:
+                    logging.info(f"Shard process {index} exited cleanly.")
+                    continue
+                if now - started[index] > SHARD_STABLE_AFTER:
+                    delays[index] = SHARD_RESTART_DELAY
+                else:
+                    delays[index] = min(delays.get(index, SHARD_RESTART_DELAY / 2) * 2, SHARD_RESTART_MAX_DELAY)
+                restart_at[index] = now + delays[index]
+                logging.warning(f"Shard process {index} exited with code {code}, restarting in {delays[index]:.0f}s.")
+            for index, at in list(restart_at.items()):
+                if now >= at:
+                    del restart_at[index]
+                    spawn(index)
+    finally:
+        for proc in children.values():
+            proc.terminate()
+        for proc in children.values():
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
 @bot.event
 async def on_app_command_error(interaction, error):
     try: await interaction.response.send_message(f"Erreur commande : {error}", ephemeral=True)
     except: await interaction.followup.send(f"Erreur commande : {error}", ephemeral=True)
-    logging.error(f"Unhandled app command error: {error}")
+    logging.error("Unhandled app command error: %s", error, exc_info=getattr(error, "original", error))
+    count_error("command", getattr(error, "original", error))
 
 if __name__ == "__main__":
+    if "--build-opus" in sys.argv:
+        audio_library.build()
+        sys.exit(0)
+    if SHARD_PROCESSES > 1 and SHARD_IDS is None:
+        run_shard_launcher(SHARD_PROCESSES, SHARD_COUNT or SHARD_PROCESSES)
+        sys.exit(0)
     print("Starting bot... Jokes will fetch in background.")
     logging.info("Bot starting up. Jokes will fetch in background.")
-    bot.run(config["token"])
\ No newline at end of file
+    bot.run(config["token"], log_handler=None)  # discord.py passe par notre file de logs
\ No newline at end of file
@@ -0,0 +1,26 @@
+"""Shared fixtures: bot.py imported against a throwaway config, like bench.py does."""
+import logging
+import os
+import shutil
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import bench  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def bot():
+    workdir = bench._prepare_workdir("http://127.0.0.1:9", {})
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import bot as module  # lit config.json dans le dossier courant
+        logging.getLogger().setLevel(logging.CRITICAL)
+        yield module
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
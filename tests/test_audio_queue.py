@@ -0,0 +1,71 @@
+import asyncio
+import os
+import time
+import types
+
+import discord
+
+import bench
+
+STOP_DELAY = 0.5  # le thread du lecteur reste « en lecture » après la fin du flux
+
+
+class WindingDown:
+    """Wraps the guild stream: once it returns b"", the player thread takes a while to exit."""
+
+    def __init__(self, source):
+        self.source = source
+
+    def read(self):
+        data = self.source.read()
+        if not data:
+            time.sleep(STOP_DELAY)
+        return data
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+class SlowStopVoiceClient(bench.FakeVoiceClient):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.streams = []
+
+    def play(self, source, after=None):
+        if self._playing:
+            raise discord.ClientException("Already playing audio.")
+        self.streams.append(source)
+        super().play(WindingDown(source), after)
+
+
+class SlowStopChannel(bench.FakeChannel):
+    async def connect(self):
+        vc = SlowStopVoiceClient(self._bot, self.guild, self, self._args)
+        self._bot._connection._voice_clients[self.guild.id] = vc
+        return vc
+
+
+def test_item_queued_while_finished_player_winds_down(bot, monkeypatch):
+    monkeypatch.setattr(bot, "AUDIO_STREAM_LINGER_FRAMES", 2)
+    monkeypatch.setattr(bot, "_make_audio_source", lambda source: bench.FakeOpusSource(None, 0.1))
+    args = types.SimpleNamespace(connect_latency=0)
+    guild = types.SimpleNamespace(id=9021, name="serveur")
+    channel = SlowStopChannel(bot.bot, guild, 9022, args)
+    interaction = bench.FakeInteraction(guild, bench.FakeMember(9023, channel))
+    clip = os.path.join(bot.AUDIO_DIR, "hibou.mp3")
+
+    async def scenario():
+        try:
+            await bot.play_audio(interaction, clip, channel)
+            await asyncio.sleep(0.2)  # le flux a fini (2 trames de silence), pas le lecteur
+            vc = bot.bot._connection._voice_clients[guild.id]
+            assert vc.is_playing() and vc.streams[-1].finished
+            await bot.play_audio(interaction, clip, channel)
+            assert len(vc.streams) == 2
+        finally:
+            bot._voice_queue_tasks.pop(guild.id).cancel()
+
+    asyncio.run(scenario())
@@ -0,0 +1,10 @@
+def test_unbroken_text_is_hard_cut_at_max_len(bot):
+    text = "a" * 25
+    chunks = bot.split_sentences(text, max_len=10)
+    assert chunks == ["a" * 10, "a" * 10, "a" * 5]
+
+
+def test_cut_after_comma_keeps_it_within_max_len(bot):
+    chunks = bot.split_sentences("un deux trois, quatre cinq six", max_len=16, short_first=False)
+    assert chunks == ["un deux trois,", "quatre cinq six"]
+    assert all(len(chunk) <= 16 for chunk in chunks)